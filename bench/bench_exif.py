@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# bench_exif.py - compares reading EXIF data with Image.open()._getexif() against
+# webalbum.exif_reader (one file at a time and in batches) over the JPEGs in a directory.
+#
+#    ./bench/bench_exif.py -p /mnt/hddData/photos/2019 -n 2000
+#
+# The results are written to stdout as JSON. Run it twice if you want warm page cache
+# numbers for all three, the first method run pays for reading the files off disk.
+
+import json
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+from PIL import Image  # noqa: E402
+from webalbum import exif_reader  # noqa: E402
+
+
+def find_jpegs(path, limit):
+    found = []
+    for dirpath, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(('.jpg', '.jpeg')):
+                found.append(os.path.join(dirpath, f))
+                if len(found) >= limit > 0:
+                    return found
+    return found
+
+
+def pil_exif(filepath):
+    try:
+        return Image.open(filepath)._getexif()
+    except Exception:
+        return None
+
+
+def run(name, files, read_all):
+    start = time.perf_counter()
+    results = read_all(files)
+    elapsed = time.perf_counter() - start
+    return results, {
+        "method": name,
+        "files": len(files),
+        "seconds": round(elapsed, 4),
+        "files_per_second": round(len(files) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--path', dest='path', default='/mnt/hddData/photos',
+                      help='directory of JPEGs to read')
+    parser.add_option('-n', '--number', dest='number', type='int', default=1000,
+                      help='number of files to read, 0 = all of them (default 1000)')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=exif_reader.DEFAULT_WORKERS,
+                      help='files read at once by the batch reader')
+    (options, args) = parser.parse_args()
+
+    files = find_jpegs(options.path, options.number)
+    if len(files) < 1:
+        print("No JPEG files found in {}".format(options.path))
+        return 1
+
+    pil, pil_stats = run("pil", files, lambda fs: [pil_exif(f) for f in fs])
+    single, single_stats = run("exif_reader", files, lambda fs: [exif_reader.read_exif(f) for f in fs])
+    batch, batch_stats = run("exif_reader_batch", files,
+                             lambda fs: [info for f, info in exif_reader.read_exif_batch(fs, options.jobs)])
+
+    mismatches = [f for f, a, b, c in zip(files, pil, single, batch) if not (a == b == c)]
+    print(json.dumps({
+        "path": options.path,
+        "results": [pil_stats, single_stats, batch_stats],
+        "mismatches": mismatches,
+    }, indent=2))
+    return 0 if len(mismatches) == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# bench_render.py - times the page renderers of www/webalbum.py against a synthetic album
+#
+#    ./bench/bench_render.py --years 2 --days 10 --images 40 -n 5 -o results.json
+#
+# A synthetic album is generated in the work directory (and reused by later runs with the same
+# shape): YEARS year directories of DAYS YYYY_MM_DD day directories, each holding IMAGES JPEGs,
+# with EXIF data on all of them and GPS positions on some, plus a few short videos. Every
+# renderer is then run cold (empty thumbnail/view/index cache before each run) and warm (cache
+# primed by an earlier run). Each of those runs in a fresh python process so its peak RSS
+# can be reported, and the results are written as JSON so they can be compared between versions.
+#
+# Syscalls are counted from /proc/self/io (read and write syscalls) plus python audit events for
+# opens and directory listings, the find(1) processes started by the searches aren't included.
+
+import importlib.util
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+WEBALBUM = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www', 'webalbum.py')
+
+AUDITED = {
+    'open': 'open',
+    'os.listdir': 'listdir',
+    'os.scandir': 'listdir',
+    'subprocess.Popen': 'exec',
+}
+
+
+def _gps(value):
+    value = abs(value)
+    d = int(value)
+    m = int((value - d) * 60)
+    s = round(((value - d) * 60 - m) * 60, 4)
+    return (float(d), float(m), float(s))
+
+
+def make_album(root, years, days, images, size, gps_ratio, videos, seed=1):
+    """Fills root with the synthetic album, returns a description of what was made"""
+    rnd = random.Random(seed)
+    made = {'images': 0, 'gps': 0, 'videos': 0}
+    for y in range(2000, 2000 + years):
+        for d in range(days):
+            t = time.gmtime(time.mktime((y, 1, 1, 12, 0, 0, 0, 0, 0)) + d * 86400)
+            day_dir = os.path.join(root, str(y), time.strftime('%Y_%m_%d', t))
+            os.makedirs(day_dir, exist_ok=True)
+            for i in range(images):
+                im = Image.new('RGB', size, (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+                exif = Image.Exif()
+                exif[0x010F] = 'Synthetic'
+                exif[0x0110] = 'Bench %d' % (i % 3)
+                exif[0x0112] = rnd.choice([1, 1, 1, 3, 6, 8])
+                exif[0x8769] = {0x9003: time.strftime('%Y:%m:%d ', t) + '%02d:%02d:00' % (8 + i // 60, i % 60)}
+                if rnd.random() < gps_ratio:
+                    lat = rnd.uniform(-60, 60)
+                    lon = rnd.uniform(-170, 170)
+                    exif[0x8825] = {1: 'N' if lat >= 0 else 'S', 2: _gps(lat), 3: 'E' if lon >= 0 else 'W', 4: _gps(lon)}
+                    made['gps'] += 1
+                im.save(os.path.join(day_dir, 'IMG_%04d.jpg' % i), quality=90, exif=exif)
+                made['images'] += 1
+    if videos > 0:
+        from moviepy.editor import ColorClip
+        video_dir = os.path.join(root, str(2000 + years - 1), 'videos')
+        os.makedirs(video_dir, exist_ok=True)
+        for v in range(videos):
+            clip = ColorClip((320, 240), color=(rnd.randrange(256), 0, 0), duration=6)
+            clip.write_videofile(os.path.join(video_dir, 'VID_%04d.mp4' % v), fps=5, logger=None)
+            made['videos'] += 1
+    return made
+
+
+def load_webalbum(album, data):
+    """Imports webalbum.py with its configuration pointed at the synthetic album"""
+    os.environ['REQUEST_METHOD'] = 'GET'
+    os.environ['QUERY_STRING'] = ''
+    spec = importlib.util.spec_from_file_location('webalbum_cgi', WEBALBUM)
+    webalbum = importlib.util.module_from_spec(spec)
+    saved_argv = sys.argv
+    sys.argv = sys.argv[:1]
+    try:
+        spec.loader.exec_module(webalbum)
+    finally:
+        sys.argv = saved_argv
+    webalbum.ALBUM_ROOT = album
+    webalbum.PREVIEW_FILE_DIR = data
+    webalbum.INDEX_DB = os.path.join(data, 'webalbum.db')
+    return webalbum
+
+
+def clear_cache(webalbum, data):
+    if getattr(webalbum, '_index_db', None) is not None:
+        webalbum._index_db.close()
+        webalbum._index_db = None
+    shutil.rmtree(data, ignore_errors=True)
+    for d in (webalbum.THUMBNAIL_DIR, webalbum.VIEW_DIR):
+        os.makedirs(data + d, exist_ok=True)
+
+
+def proc_io():
+    counts = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counts[key.strip()] = int(value)
+    except OSError:
+        pass
+    return {'read': counts.get('syscr', 0), 'write': counts.get('syscw', 0)}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_scenario(album, data, renderer, cache, iterations, results):
+    """Runs one renderer `iterations` times in this (child) process and reports to results"""
+    webalbum = load_webalbum(album, data)
+    root = webalbum.AlbumItem(album)
+    day_dirs = sorted(os.path.join(album, y, d) for y in os.listdir(album) for d in os.listdir(os.path.join(album, y))
+                      if d[:4].isdigit())
+    day = webalbum.AlbumItem(day_dirs[len(day_dirs) // 2])
+    images = sorted(f for f in os.listdir(day.fullpath) if f.endswith('.jpg'))
+    image = webalbum.AlbumItem(os.path.join(day.fullpath, images[len(images) // 2]))
+
+    renderers = {
+        'dir_page': lambda: webalbum.render_dir_page(day),
+        'file_page': lambda: webalbum.render_file_page(image),
+        'search': lambda: webalbum.render_search(day.basename[:7], root),
+        'video_search': lambda: webalbum.render_video_search(root),
+    }
+    render = renderers[renderer]
+
+    audit_counts = {}
+
+    def audit(event, args):
+        name = AUDITED.get(event)
+        if name is not None:
+            audit_counts[name] = audit_counts.get(name, 0) + 1
+    sys.addaudithook(audit)
+
+    if cache == 'warm':
+        render()
+    latencies = []
+    syscalls = {}
+    size = 0
+    for i in range(iterations):
+        if cache == 'cold':
+            clear_cache(webalbum, data)
+        audit_counts.clear()
+        before = proc_io()
+        start = time.perf_counter()
+        size = len(render())
+        latencies.append(time.perf_counter() - start)
+        after = proc_io()
+        counts = dict(audit_counts)
+        counts['read'] = after['read'] - before['read']
+        counts['write'] = after['write'] - before['write']
+        for key, value in counts.items():
+            syscalls[key] = syscalls.get(key, 0) + value
+
+    results.put({
+        'renderer': renderer,
+        'cache': cache,
+        'iterations': iterations,
+        'page_bytes': size,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p90': round(percentile(latencies, 90) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'max': round(max(latencies) * 1000, 3),
+        },
+        'syscalls_per_render': {k: round(v / float(iterations), 1) for k, v in sorted(syscalls.items())},
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-w', '--workdir', dest='workdir', default=os.path.join(tempfile.gettempdir(), 'webalbum-bench'),
+                      help='where the synthetic album and the cache are made')
+    parser.add_option('--years', dest='years', type='int', default=2, help='year directories (default 2)')
+    parser.add_option('--days', dest='days', type='int', default=10, help='day directories per year (default 10)')
+    parser.add_option('--images', dest='images', type='int', default=40, help='images per day directory (default 40)')
+    parser.add_option('--size', dest='size', default='2000x1500', help='image size (default 2000x1500)')
+    parser.add_option('--gps', dest='gps', type='float', default=0.5, help='fraction of images with GPS (default 0.5)')
+    parser.add_option('--videos', dest='videos', type='int', default=3, help='number of videos (default 3)')
+    parser.add_option('-n', '--iterations', dest='iterations', type='int', default=5,
+                      help='renders timed per renderer and cache state (default 5)')
+    parser.add_option('-r', '--renderer', dest='renderers', action='append', default=None,
+                      help='renderer to time: dir_page, file_page, search or video_search (default all)')
+    parser.add_option('-o', '--output', dest='output', default=None, help='write the JSON here rather than stdout')
+    (options, args) = parser.parse_args()
+
+    shape = dict(years=options.years, days=options.days, images=options.images,
+                 size=tuple(int(v) for v in options.size.split('x')), gps_ratio=options.gps, videos=options.videos)
+    album = os.path.join(options.workdir, 'album-%(years)d-%(days)d-%(images)d-%(videos)d' % shape)
+    data = os.path.join(options.workdir, 'data')
+    if not os.path.isdir(album):
+        start = time.perf_counter()
+        made = make_album(album + '.tmp', **shape)
+        os.rename(album + '.tmp', album)
+        sys.stderr.write('made %s in %.1fs\n' % (made, time.perf_counter() - start))
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    scenarios = []
+    for renderer in options.renderers or ['dir_page', 'file_page', 'search', 'video_search']:
+        for cache in ('cold', 'warm'):
+            p = context.Process(target=run_scenario, args=(album, data, renderer, cache, options.iterations, results))
+            p.start()
+            result = results.get()
+            p.join()
+            scenarios.append(result)
+            sys.stderr.write('%(renderer)s %(cache)s %(latency_ms)s\n' % result)
+
+    out = json.dumps({
+        'album': dict(shape, size=options.size),
+        'python': sys.version.split()[0],
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scenarios': scenarios,
+    }, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
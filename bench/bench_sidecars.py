@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# bench_sidecars.py - compares loading the per image metadata of www/webalbum.py from the
+# JSON .meta files against the pickled .exif/.gps files older versions wrote
+#
+#    ./bench/bench_sidecars.py -n 1000 -r 5 --makernote 4096
+#
+# N synthetic JPEGs are made in the work directory (and reused by later runs with the same
+# shape) with EXIF data like a camera writes: make, model, exposure settings as IFDRationals,
+# a MakerNote blob of MAKERNOTE bytes and a GPS position on some of them. For each image the
+# old .exif/.gps files and the new .meta file are written from the same EXIF data, then both
+# are loaded (with warm page cache) REPEATS times and the best time per 1,000 images is
+# reported along with the size of the files and how long converting the old files takes.
+# The results are written to stdout as JSON.
+
+import importlib.util
+import json
+import optparse
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+WEBALBUM = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www', 'webalbum.py')
+
+
+def _gps(value):
+    value = abs(value)
+    d = int(value)
+    m = int((value - d) * 60)
+    s = round(((value - d) * 60 - m) * 60, 4)
+    return (float(d), float(m), float(s))
+
+
+def make_album(root, images, makernote, gps_ratio, seed=1):
+    rnd = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    for i in range(images):
+        im = Image.new('RGB', (64, 48), (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        exif = Image.Exif()
+        exif[0x010F] = 'Synthetic'
+        exif[0x0110] = 'Bench %d' % (i % 3)
+        exif[0x0112] = rnd.choice([1, 1, 1, 3, 6, 8])
+        exif[0x8769] = {
+            0x9003: '2019:03:%02d %02d:%02d:00' % (1 + i % 28, 8 + i // 60 % 12, i % 60),
+            0x829A: (1, rnd.choice([60, 125, 250, 500])),  # ExposureTime
+            0x829D: (rnd.choice([18, 28, 40, 56]), 10),  # FNumber
+            0x920A: (rnd.randrange(24, 200), 1),  # FocalLength
+            0x927C: bytes(rnd.randrange(256) for b in range(makernote)),  # MakerNote
+            0xA002: 4000,  # ExifImageWidth
+            0xA003: 3000,  # ExifImageHeight
+        }
+        if rnd.random() < gps_ratio:
+            lat = rnd.uniform(-60, 60)
+            lon = rnd.uniform(-170, 170)
+            exif[0x8825] = {1: 'N' if lat >= 0 else 'S', 2: _gps(lat), 3: 'E' if lon >= 0 else 'W', 4: _gps(lon)}
+        im.save(os.path.join(root, 'IMG_%04d.jpg' % i), quality=80, exif=exif)
+
+
+def load_webalbum(album, data):
+    """Imports webalbum.py with its configuration pointed at the synthetic album"""
+    os.environ['REQUEST_METHOD'] = 'GET'
+    os.environ['QUERY_STRING'] = ''
+    spec = importlib.util.spec_from_file_location('webalbum_cgi', WEBALBUM)
+    webalbum = importlib.util.module_from_spec(spec)
+    saved_argv = sys.argv
+    sys.argv = sys.argv[:1]
+    try:
+        spec.loader.exec_module(webalbum)
+    finally:
+        sys.argv = saved_argv
+    webalbum.ALBUM_ROOT = album
+    webalbum.PREVIEW_FILE_DIR = data
+    webalbum.INDEX_DB = os.path.join(data, 'webalbum.db')
+    return webalbum
+
+
+def write_sidecars(webalbum, items):
+    """Writes the old .exif/.gps files and the new .meta file of every item"""
+    for item in items:
+        exif_data = item.exif_data
+        legacy = item.meta_file_local[:-len(webalbum.META_EXTENSION)]
+        with open(legacy + '.exif', 'wb') as f:
+            pickle.dump(exif_data, f)
+        gps = webalbum.get_lat_lon(exif_data)
+        if gps[0] is not None:
+            with open(legacy + '.gps', 'wb') as f:
+                pickle.dump(gps, f)
+        webalbum.write_meta_file(item.meta_file_local, webalbum.get_image_meta(exif_data))
+
+
+def load_pickles(webalbum, paths):
+    # what load_exif_data_from_file() and load_gps_from_file() used to do
+    for path in paths:
+        legacy = webalbum.AlbumItem(path).meta_file_local[:-len(webalbum.META_EXTENSION)]
+        with open(legacy + '.exif', 'rb') as f:
+            pickle.load(f)
+        if os.path.isfile(legacy + '.gps'):
+            with open(legacy + '.gps', 'rb') as f:
+                pickle.load(f)
+
+
+def load_metas(webalbum, paths):
+    for path in paths:
+        if webalbum.AlbumItem(path).load_meta_from_file() is None:
+            raise RuntimeError('no metadata for %s' % path)
+
+
+def best_per_1000(load, paths, repeats):
+    best = None
+    for r in range(repeats):
+        start = time.perf_counter()
+        load(paths)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000.0 * 1000 / len(paths), 3)
+
+
+def sidecar_bytes(directory, extensions):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(extensions))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-w', '--workdir', dest='workdir', default=os.path.join(tempfile.gettempdir(), 'webalbum-bench'),
+                      help='where the synthetic images and sidecar files are made')
+    parser.add_option('-n', '--images', dest='images', type='int', default=1000, help='number of images (default 1000)')
+    parser.add_option('-r', '--repeats', dest='repeats', type='int', default=5,
+                      help='loads timed for each kind of file, the best is reported (default 5)')
+    parser.add_option('--makernote', dest='makernote', type='int', default=4096,
+                      help='bytes of MakerNote in each image (default 4096)')
+    parser.add_option('--gps', dest='gps', type='float', default=0.5, help='fraction of images with GPS (default 0.5)')
+    (options, args) = parser.parse_args()
+
+    album = os.path.join(options.workdir, 'sidecars-%d-%d' % (options.images, options.makernote))
+    data = os.path.join(options.workdir, 'sidecars-data')
+    if not os.path.isdir(album):
+        make_album(album + '.tmp', options.images, options.makernote, options.gps)
+        os.rename(album + '.tmp', album)
+    shutil.rmtree(data, ignore_errors=True)
+    webalbum = load_webalbum(album, data)
+    thumbdir = data + webalbum.THUMBNAIL_DIR
+    os.makedirs(thumbdir)
+
+    paths = sorted(os.path.join(album, f) for f in os.listdir(album))
+    write_sidecars(webalbum, [webalbum.AlbumItem(p) for p in paths])
+    results = {
+        'pickle': {
+            'ms_per_1000': best_per_1000(lambda ps: load_pickles(webalbum, ps), paths, options.repeats),
+            'bytes_per_image': sidecar_bytes(thumbdir, webalbum.LEGACY_SIDECARS) // len(paths),
+        },
+        'meta': {
+            'ms_per_1000': best_per_1000(lambda ps: load_metas(webalbum, ps), paths, options.repeats),
+            'bytes_per_image': sidecar_bytes(thumbdir, webalbum.META_EXTENSION) // len(paths),
+        },
+    }
+
+    # the conversion only does anything for images without a .meta file
+    for entry in os.scandir(thumbdir):
+        if entry.name.endswith(webalbum.META_EXTENSION):
+            os.remove(entry.path)
+    start = time.perf_counter()
+    converted, dropped = webalbum.convert_sidecars()
+    results['convert'] = {
+        'ms_per_1000': round((time.perf_counter() - start) * 1000.0 * 1000 / len(paths), 3),
+        'converted': converted,
+        'dropped': dropped,
+    }
+
+    print(json.dumps({
+        'images': len(paths),
+        'makernote_bytes': options.makernote,
+        'python': sys.version.split()[0],
+        'speedup': round(results['pickle']['ms_per_1000'] / results['meta']['ms_per_1000'], 2),
+        'results': results,
+    }, indent=2))
+    return 0 if dropped == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# camera_index.py - persistent index of the camera model and capture time of the album's JPEGs
+#
+# latest-from-cam3 used to read the EXIF data of every JPEG in the album on every run. The
+# index keeps the model and capture time of each file along with its mtime, so a refresh only
+# has to stat the files and read the EXIF data of the ones that are new or have changed.
+
+import os
+import sqlite3
+import time
+
+try:
+    from webalbum import exif_reader
+except ImportError:  # running the script straight out of the source tree
+    import exif_reader
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.cache', 'webalbum', 'cameras.db')
+
+MODEL_TAG = 0x0110
+DATE_TAGS = (0x9003, 0x9004, 0x0132)  # DateTimeOriginal, DateTimeDigitized, DateTime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    model TEXT,
+    taken TEXT
+);
+CREATE INDEX IF NOT EXISTS files_model_taken ON files(model, taken);
+"""
+
+
+def get_taken(info):
+    """Returns the capture time from raw exif data as "YYYY-MM-DD HH:MM:SS" or None"""
+    for tag in DATE_TAGS:
+        value = info.get(tag)
+        if not isinstance(value, str):
+            continue
+        try:
+            taken = time.strptime(value.strip().replace("-", ":")[:19], "%Y:%m:%d %H:%M:%S")
+            return time.strftime("%Y-%m-%d %H:%M:%S", taken)
+        except ValueError:
+            continue
+    return None
+
+
+def get_model(info):
+    model = info.get(MODEL_TAG)
+    if not isinstance(model, str):
+        return None
+    return model.strip('\x00 ') or None
+
+
+class CameraIndex:
+    def __init__(self, db_path=DEFAULT_INDEX):
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.executescript(SCHEMA)
+
+    def refresh(self, path, files):
+        """
+        Brings the index up to date with files, the full list of JPEGs under path. Returns the
+        number of files read and the number dropped from the index.
+        """
+        path = os.path.abspath(path)
+        known = dict(self.db.execute("SELECT path, mtime FROM files WHERE path >= ? AND path < ?",
+                                     (path + os.sep, path + chr(ord(os.sep) + 1))))
+        changed = []
+        mtimes = {}
+        for f in files:
+            f = os.path.abspath(f)
+            try:
+                mtime = os.stat(f).st_mtime
+            except OSError:
+                continue
+            mtimes[f] = mtime
+            if known.get(f) != mtime:
+                changed.append(f)
+        rows = []
+        for f, info in exif_reader.read_exif_batch(changed):
+            info = info or {}
+            rows.append((f, mtimes[f], get_model(info), get_taken(info)))
+        gone = [(f,) for f in known if f not in mtimes]
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+        self.db.executemany("DELETE FROM files WHERE path = ?", gone)
+        self.db.commit()
+        return len(rows), len(gone)
+
+    def cameras(self, path):
+        path = os.path.abspath(path)
+        return [model for (model,) in self.db.execute(
+            "SELECT DISTINCT model FROM files WHERE model IS NOT NULL AND path >= ? AND path < ? ORDER BY model",
+            (path + os.sep, path + chr(ord(os.sep) + 1)))]
+
+    def find(self, path, cam_search, limit=0):
+        """
+        Returns (path, model, taken) for the files under path from cameras whose model contains
+        cam_search (ignoring case) in capture time order. With a limit only the latest `limit`
+        files are returned.
+        """
+        path = os.path.abspath(path)
+        sql = "SELECT path, model, taken FROM files WHERE path >= ? AND path < ? " \
+              "AND model IS NOT NULL AND instr(lower(model), ?) > 0 ORDER BY taken DESC, path DESC"
+        args = [path + os.sep, path + chr(ord(os.sep) + 1), cam_search.lower()]
+        if limit > 0:
+            sql += " LIMIT ?"
+            args.append(limit)
+        found = self.db.execute(sql, args).fetchall()
+        found.reverse()
+        return found
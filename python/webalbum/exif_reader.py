@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# exif_reader.py - lightweight EXIF reading for bulk jobs
+#
+# Image.open() followed by _getexif() works out the file format, sets up the format plugin
+# and parses the whole JPEG header just to get at the EXIF block. When the job is reading the
+# EXIF of tens of thousands of photos that overhead is most of the time taken. The functions
+# here instead walk the JPEG segment markers using a small bounded read, pull out just the
+# APP1 "Exif" segment and hand the TIFF structure in it to PIL's Exif class for decoding, so
+# the values returned are exactly the same as the ones _getexif() would have returned.
+# TIFF files are the EXIF structure themselves so only the head of the file is read for them.
+
+from concurrent.futures import ThreadPoolExecutor
+import struct
+
+from PIL import Image
+from PIL.ExifTags import TAGS, GPSTAGS
+
+# the first read of each file, big enough to hold the APP1 segment of most camera JPEGs
+HEAD_READ_SIZE = 16 * 1024
+
+# give up looking for the APP1 segment this far into a JPEG
+MAX_SCAN_SIZE = 256 * 1024
+
+# how much of a TIFF file is read for its IFDs
+TIFF_READ_SIZE = 256 * 1024
+
+# files read at once by read_exif_batch()
+DEFAULT_WORKERS = 8
+
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+
+JPEG_SOI = b'\xff\xd8'
+TIFF_HEADERS = (b'II*\x00', b'MM\x00*')
+EXIF_HEADER = b'Exif\x00\x00'
+
+
+class _Reader:
+    """Bounded, seekable view of the start of a file"""
+    def __init__(self, f):
+        self.f = f
+        self.buf = f.read(HEAD_READ_SIZE)
+        self.buf_start = 0
+
+    def read(self, offset, length):
+        end = offset + length
+        if offset < self.buf_start or end > self.buf_start + len(self.buf):
+            self.f.seek(offset)
+            self.buf = self.f.read(max(length, HEAD_READ_SIZE))
+            self.buf_start = offset
+        return self.buf[offset - self.buf_start:end - self.buf_start]
+
+
+def _find_jpeg_exif(reader):
+    """Returns the TIFF data of the APP1 Exif segment of a JPEG or None if there isn't one"""
+    pos = 2
+    while pos < MAX_SCAN_SIZE:
+        marker = reader.read(pos, 4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:
+            # fill byte before a marker
+            pos += 1
+            continue
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            # markers without a length
+            pos += 2
+            continue
+        if code in (0xDA, 0xD9):
+            # start of the image data (or the end of the image), EXIF always comes before this
+            return None
+        length = struct.unpack('>H', marker[2:4])[0]
+        if code == 0xE1:
+            segment = reader.read(pos + 4, length - 2)
+            if segment.startswith(EXIF_HEADER):
+                return segment[len(EXIF_HEADER):]
+        pos += 2 + length
+    return None
+
+
+def read_exif_tiff(filepath):
+    """
+    Returns the raw TIFF structure holding the EXIF data of a JPEG or TIFF file or None if the
+    file isn't one of those or has no EXIF data.
+    """
+    with open(str(filepath), 'rb') as f:
+        reader = _Reader(f)
+        head = reader.read(0, 4)
+        if head.startswith(JPEG_SOI):
+            return _find_jpeg_exif(reader)
+        if head in TIFF_HEADERS:
+            return reader.read(0, TIFF_READ_SIZE)
+    return None
+
+
+def load_exif(tiff_data):
+    """
+    Decodes the raw TIFF structure into the same {tag: value} dictionary as _getexif() gives,
+    the Exif sub-IFD tags are merged in and the GPS tags are a dictionary under GPSInfo.
+    """
+    exif = Image.Exif()
+    exif.load(tiff_data)
+    info = dict(exif)
+    if EXIF_IFD in info:
+        info.update(exif.get_ifd(EXIF_IFD))
+    if GPS_IFD in info:
+        info[GPS_IFD] = exif.get_ifd(GPS_IFD)
+    return info
+
+
+def read_exif(filepath):
+    """
+    Returns the {tag: value} dictionary of the EXIF data in a JPEG or TIFF file or None if
+    there isn't any, equivalent to Image.open(filepath)._getexif().
+    """
+    tiff_data = read_exif_tiff(filepath)
+    if not tiff_data:
+        return None
+    try:
+        return load_exif(tiff_data) or None
+    except (SyntaxError, struct.error, ValueError, KeyError):
+        # a corrupt or truncated EXIF block, PIL raises the same for these
+        return None
+
+
+def _read_exif_or_none(filepath):
+    try:
+        return read_exif(filepath)
+    except OSError:
+        return None
+
+
+def read_exif_batch(filepaths, workers=DEFAULT_WORKERS):
+    """
+    Reads the EXIF data of many files at once, yields (filepath, exif) tuples in the same order
+    as filepaths where exif is what read_exif() returns (None for unreadable files too).
+    """
+    filepaths = list(filepaths)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for filepath, info in zip(filepaths, pool.map(_read_exif_or_none, filepaths)):
+            yield filepath, info
+
+
+def decode_exif(info, decode_gps=True):
+    """
+    Returns a copy of the EXIF data with tag names rather than numbers as the keys. The GPS
+    tags are converted too unless decode_gps is False.
+    """
+    decoded = {}
+    for tag, value in info.items():
+        name = TAGS.get(tag, tag)
+        if name == "GPSInfo" and decode_gps and hasattr(value, 'items'):
+            value = {GPSTAGS.get(t, t): v for t, v in value.items()}
+        decoded[name] = value
+    return decoded
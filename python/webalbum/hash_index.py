@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# hash_index.py - persistent index of the content hashes of the files in the album
+#
+# Finding out whether a file is already somewhere in the album by hashing is expensive, so
+# the hashes are worked out in stages and only when they are needed:
+#    size    - from a stat, files of a size nobody else has can't be duplicates
+#    partial - sha256 of the first and last PARTIAL_SIZE bytes, only for files that share a size
+#    sha256  - of the whole file, only for files that share a partial hash
+# Every hash worked out is kept (an sqlite database) along with the size and mtime of the file
+# so it never has to be worked out again until the file changes.
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+# used for hashing files
+BLOCK_SIZE = 65536  # The size of each read from the file
+
+# the bytes read from each end of the file for the partial hash
+PARTIAL_SIZE = 65536
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    partial TEXT,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS files_size ON files(size);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256);
+"""
+
+
+def get_hash(_file):
+    """
+    Return the sha256sum of the specified file in hex-string format.
+    """
+    file_hash = hashlib.sha256()
+    with open(str(_file), 'rb') as f:
+        fb = f.read(BLOCK_SIZE)
+        while len(fb) > 0:
+            file_hash.update(fb)
+            fb = f.read(BLOCK_SIZE)
+    return file_hash.hexdigest()
+
+
+def get_partial_hash(_file):
+    """
+    Return the sha256sum of the first and last PARTIAL_SIZE bytes of the file in hex-string format.
+    """
+    file_hash = hashlib.sha256()
+    with open(str(_file), 'rb') as f:
+        file_hash.update(f.read(PARTIAL_SIZE))
+        size = os.fstat(f.fileno()).st_size
+        if size > PARTIAL_SIZE:
+            f.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+            file_hash.update(f.read(PARTIAL_SIZE))
+    return file_hash.hexdigest()
+
+
+class HashIndex:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # hashes worked out for source files, kept so they can be stored against the copy
+        self.src_hashes = {}
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def refresh(self, rootdir):
+        """
+        Brings the index up to date with the files under rootdir. Only a stat is needed for
+        files that haven't changed, the hashes of changed files are forgotten.
+        """
+        rootdir = os.path.abspath(rootdir)
+        with self.lock:
+            known = {path: (size, mtime) for path, size, mtime in self.db.execute(
+                "SELECT path, size, mtime FROM files WHERE path >= ? AND path < ?",
+                (rootdir + os.sep, rootdir + chr(ord(os.sep) + 1)))}
+        seen = set()
+        changed = []
+        for path, dirs, files in os.walk(rootdir):
+            for f in files:
+                filepath = os.path.join(path, f)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                seen.add(filepath)
+                if known.get(filepath) != (st.st_size, st.st_mtime):
+                    changed.append((filepath, st.st_size, st.st_mtime))
+        gone = [(path,) for path in known if path not in seen]
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files(path, size, mtime) VALUES (?, ?, ?)", changed)
+            self.db.executemany("DELETE FROM files WHERE path = ?", gone)
+            self.db.commit()
+        return len(changed), len(gone)
+
+    def add(self, path, src=None, sha256=None):
+        """
+        Adds a file to the index, src is the file it was copied from (if any) and sha256 its hash
+        if that is already known.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        partial, src_sha256 = self.src_hashes.pop(src, (None, None))
+        sha256 = sha256 or src_sha256
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                            (path, st.st_size, st.st_mtime, partial, sha256))
+            self.db.commit()
+
+    def _stored_hash(self, path, column):
+        """Returns the partial or full (column) hash of an indexed file, working it out if needed"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime, %s FROM files WHERE path = ?" % column, (path,)).fetchone()
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if row is None or st is None or (st.st_size, st.st_mtime) != (row[0], row[1]):
+            # gone or changed since it was indexed
+            with self.lock:
+                if st is None:
+                    self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+                else:
+                    self.db.execute("INSERT OR REPLACE INTO files(path, size, mtime) VALUES (?, ?, ?)",
+                                    (path, st.st_size, st.st_mtime))
+                self.db.commit()
+            if st is None:
+                return None
+        elif row[2] is not None:
+            return row[2]
+        value = get_partial_hash(path) if column == 'partial' else get_hash(path)
+        with self.lock:
+            self.db.execute("UPDATE files SET %s = ? WHERE path = ?" % column, (value, path))
+            self.db.commit()
+        return value
+
+    def find_duplicate(self, filepath):
+        """Returns the path of a file in the index with the same contents as filepath or None"""
+        size = os.path.getsize(filepath)
+        with self.lock:
+            candidates = [row[0] for row in self.db.execute(
+                "SELECT path FROM files WHERE size = ?", (size,))]
+        if len(candidates) == 0:
+            return None
+
+        partial = get_partial_hash(filepath)
+        self.src_hashes[filepath] = (partial, None)
+        candidates = [c for c in candidates if self._stored_hash(c, 'partial') == partial]
+        if len(candidates) == 0:
+            return None
+
+        sha256 = get_hash(filepath)
+        self.src_hashes[filepath] = (partial, sha256)
+        for c in candidates:
+            if self._stored_hash(c, 'sha256') == sha256:
+                self.src_hashes.pop(filepath, None)
+                return c
+        return None
+
+    def duplicate_clusters(self):
+        """Returns a list of (sha256, size, [paths]) for every set of identical files"""
+        with self.lock:
+            sized = [row[0] for row in self.db.execute(
+                "SELECT path FROM files WHERE size IN "
+                "(SELECT size FROM files GROUP BY size HAVING COUNT(*) > 1)")]
+        for path in sized:
+            self._stored_hash(path, 'partial')
+        with self.lock:
+            partials = [row[0] for row in self.db.execute(
+                "SELECT path FROM files WHERE partial IS NOT NULL AND (size, partial) IN "
+                "(SELECT size, partial FROM files GROUP BY size, partial HAVING COUNT(*) > 1)")]
+        for path in partials:
+            self._stored_hash(path, 'sha256')
+        clusters = {}
+        with self.lock:
+            for path, size, sha256 in self.db.execute(
+                    "SELECT path, size, sha256 FROM files WHERE sha256 IN "
+                    "(SELECT sha256 FROM files GROUP BY sha256 HAVING COUNT(*) > 1) ORDER BY path"):
+                clusters.setdefault((sha256, size), []).append(path)
+        return sorted([(sha256, size, paths) for (sha256, size), paths in clusters.items()],
+                      key=lambda c: c[2][0])
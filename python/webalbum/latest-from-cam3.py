@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import heapq
 import logging
 from logging import handlers
 import os
 import sys
-from PIL import Image
-from PIL.ExifTags import TAGS
+
+try:
+    from webalbum import camera_index
+    from webalbum import exif_reader
+except ImportError:  # running the script straight out of the source tree
+    import camera_index
+    import exif_reader
 
 # setup logging to stdout and syslog
 logger = logging.getLogger(__file__)
@@ -22,24 +29,8 @@ for handler, formatter in handlers_and_formatters:
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-
-def get_exif_data(image):
-    """Returns a dictionary from the exif data of an PIL Image item. Also converts the GPS Tags"""
-    info = image._getexif()
-    if info:
-        for tag, value in info.items():
-            decoded = TAGS.get(tag, tag)
-            if decoded == "Model":
-                return value
-    return None
-
-
-def get_camera_from_image(imgfile):
-    try:
-        img = Image.open(imgfile)
-        return get_exif_data(img)
-    except Image.UnidentifiedImageError as exc:
-        logger.error(f"{imgfile}: {str(exc)}")
+# files per job handed to each process when scanning without the index
+SHARD_SIZE = 200
 
 
 def find_files(path, filt=None):
@@ -50,19 +41,105 @@ def find_files(path, filt=None):
     return filteredfiles
 
 
-def find_cam_files(path, cam_search):
-    camfiles = []
-    for f in find_files(path):
-        camera = get_camera_from_image(f)
+def iter_files(path):
+    """Same files as find_files() but yielded as they are found"""
+    for dir, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if f.lower().endswith(".jpg"):
+                yield dir+os.sep+f
+
+
+def scan_shard(imgfiles, cam_search):
+    """Returns (file, camera, taken) for the files from cameras matching cam_search"""
+    matches = []
+    for imgfile in imgfiles:
+        try:
+            info = exif_reader.read_exif(imgfile) or {}
+        except OSError as exc:
+            logger.error(f"{imgfile}: {str(exc)}")
+            continue
+        camera = camera_index.get_model(info)
         if (camera is not None) and (cam_search.lower() in camera.lower()):
-            camfiles.append((f, camera))
-    return camfiles
+            matches.append((imgfile, camera, camera_index.get_taken(info)))
+    return matches
+
+
+def scan_cam_files(path, cam_search, jobs=1):
+    """
+    Reads every JPEG under path and yields (file, camera, taken) for the ones from cameras
+    matching cam_search as they are found. The files are handed out to `jobs` processes
+    SHARD_SIZE at a time, with only a couple of shards per process queued at once.
+    """
+    def shards():
+        shard = []
+        for imgfile in iter_files(path):
+            shard.append(imgfile)
+            if len(shard) >= SHARD_SIZE:
+                yield shard
+                shard = []
+        if len(shard) > 0:
+            yield shard
+
+    if jobs <= 1:
+        for shard in shards():
+            yield from scan_shard(shard, cam_search)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for shard in shards():
+            pending.add(pool.submit(scan_shard, shard, cam_search))
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in pending:
+            yield from future.result()
+
+
+def get_index(path, index_file):
+    """Opens the camera index and brings it up to date with the JPEGs under path"""
+    index = camera_index.CameraIndex(index_file)
+    read, gone = index.refresh(path, find_files(path))
+    logger.debug(f"camera index {index_file}: {read} files read, {gone} files dropped")
+    return index
+
+
+def find_cam_files(path, cam_search, limit=0, index_file=None, jobs=1):
+    """
+    Returns (file, camera) for the files from cameras matching cam_search in capture time order,
+    only the latest `limit` of them when limit > 0. Without an index_file every JPEG under path
+    is read (by `jobs` processes).
+    """
+    if index_file is not None:
+        index = get_index(path, index_file)
+        return [(f, camera) for f, camera, taken in index.find(path, cam_search, limit=limit)]
+
+    def capture_order(match):
+        f, camera, taken = match
+        return (taken or '', f)
+
+    matches = scan_cam_files(path, cam_search, jobs=jobs)
+    if limit > 0:
+        # only ever holds the newest `limit` matches
+        matches = heapq.nlargest(limit, matches, key=capture_order)
+    return [(f, camera) for f, camera, taken in sorted(matches, key=capture_order)]
+
+
+def stream_cam_files(path, cam_search, jobs=1):
+    """Prints the files from cameras matching cam_search as they are found"""
+    print("path: {}".format(path))
+    found = 0
+    for f, camera, taken in scan_cam_files(path, cam_search, jobs=jobs):
+        print("{:<100} {}".format(f, camera), flush=True)
+        found += 1
+    if found < 1:
+        print("No files found for camera search '{}'".format(cam_search))
 
 
-def list_cam_files(path, cam_search, limit=50):
-    camfiles = find_cam_files(path, cam_search)
-    if (limit > 0) and (len(camfiles) > limit):
-        camfiles = camfiles[-limit+1:]
+def list_cam_files(path, cam_search, limit=50, index_file=None, jobs=1):
+    camfiles = find_cam_files(path, cam_search, limit=limit, index_file=index_file, jobs=jobs)
     print("path: {}".format(path))
     if len(camfiles) < 1:
         print("No files found for camera search '{}'".format(cam_search))
@@ -71,17 +148,18 @@ def list_cam_files(path, cam_search, limit=50):
             print("{:<100} {}".format(f, camera))
 
 
-def get_cams_list(path):
+def get_cams_list(path, index_file=None, jobs=1):
+    if index_file is not None:
+        return get_index(path, index_file).cameras(path)
+
     cams = set()
-    for f in find_files(path):
-        camera = get_camera_from_image(f)
-        if (camera is not None):
-            cams.add(camera)
-    return list(cams)
+    for f, camera, taken in scan_cam_files(path, '', jobs=jobs):
+        cams.add(camera)
+    return sorted(cams)
 
 
-def list_cams(path):
-    cams = get_cams_list(path)
+def list_cams(path, index_file=None, jobs=1):
+    cams = get_cams_list(path, index_file=index_file, jobs=jobs)
     print("path: {}".format(path))
     if len(cams) < 1:
         print("No camera info found")
@@ -98,19 +176,34 @@ def main():
                       help="camera to search for")
     parser.add_option('-l', '--list', dest='list', default=False, action='store_true',
                       help='list the cameras found')
-    parser.add_option('-L', '--limit', dest='limit', default=50,
+    parser.add_option('-L', '--limit', dest='limit', type='int', default=50,
                       help='limit the list to the last LIMIT number of results, default 50, 0 = no limit')
+    parser.add_option('-i', '--index', dest='index', default=camera_index.DEFAULT_INDEX,
+                      help='camera index file, only new or changed files are read on each run '
+                           '(default {})'.format(camera_index.DEFAULT_INDEX))
+    parser.add_option('-n', '--no-index', dest='no_index', default=False, action='store_true',
+                      help="don't use the camera index, read every file")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=os.cpu_count() or 1,
+                      help='processes reading files when not using the index (default {})'.format(os.cpu_count()))
+    parser.add_option('-s', '--stream', dest='stream', default=False, action='store_true',
+                      help='with -n, print the matching files as they are found (in no particular order, '
+                           'LIMIT is ignored)')
     (options, args) = parser.parse_args()
+    index_file = None if options.no_index else options.index
 
     if options.list:
-        list_cams(options.path)
+        list_cams(options.path, index_file=index_file, jobs=options.jobs)
         return 0
 
     if options.camera is None:
         print("TODO: USAGE\n\n")
         return 1
 
-    list_cam_files(options.path, options.camera, limit=options.limit)
+    if options.stream and index_file is None:
+        stream_cam_files(options.path, options.camera, jobs=options.jobs)
+        return 0
+
+    list_cam_files(options.path, options.camera, limit=options.limit, index_file=index_file, jobs=options.jobs)
     return 0
 
 
@@ -13,24 +13,32 @@
 # will still go into the folder with the modified name rather than a new folder with the same date.
 
 
-import hashlib
 import logging
 from logging import handlers
 import optparse
 import os
+import queue
+import re
 import sys
 from pathlib import Path
 from random import randint
-import shutil
+import threading
 import time
 import traceback
 
-from PIL import Image
-from PIL.ExifTags import TAGS
-from PIL import UnidentifiedImageError
+try:
+    from webalbum import exif_reader
+    from webalbum.hash_index import HashIndex, get_hash
+    from webalbum import transfer
+except ImportError:  # running the script straight out of the source tree
+    import exif_reader
+    from hash_index import HashIndex, get_hash
+    import transfer
 
-# used for hashing files
-BLOCK_SIZE = 65536  # The size of each read from the file
+# used by the pipelined copy (-j), files waiting between stages per worker and how often
+# the progress gets logged in seconds
+QUEUE_DEPTH = 4
+PROGRESS_INTERVAL = 5.0
 
 # setup logging to stdout and syslog
 logger = logging.getLogger(__file__)
@@ -52,19 +60,6 @@ def format_date(day, month, year):
     return str(year) + '_' + str(month) + '_' + str(day)
 
 
-def get_hash(_file):
-    """
-    Return the sha256sum of the specified file in hex-string format.
-    """
-    file_hash = hashlib.sha256()  # Create the hash object, can use something other than `.sha256()` if you wish
-    with open(str(_file), 'rb') as f:  # Open the file to read it's bytes
-        fb = f.read(BLOCK_SIZE)  # Read from the file. Take in the amount declared above
-        while len(fb) > 0:  # While there is still data being read from the file
-            file_hash.update(fb)  # Update the hash
-            fb = f.read(BLOCK_SIZE)  # Read the next block from the file
-    return file_hash.hexdigest()  # returns the familiar hex string format
-
-
 def rename_destfile(path):
     if not isinstance(path, Path):
         path = Path(path)
@@ -74,21 +69,16 @@ def rename_destfile(path):
 
 # get embedded image data
 def get_exif_image(filepath):
-    ret = {}
     try:
-        i = Image.open(filepath)
-    except UnidentifiedImageError as exc:
-        logger.error(f"Error reading file as image (maybe it isn't an image?): {filepath} {str(exc)}")
+        info = exif_reader.read_exif(filepath)
+    except OSError as exc:
+        logger.error(f"Error reading file: {filepath} {str(exc)}")
         return None
 
-    info = i._getexif()
     if not hasattr(info, 'items'):
-        logger.error(f"No EXIF data found in image: {filepath}")
+        logger.error(f"No EXIF data found in file (maybe it isn't an image?): {filepath}")
         return None
-    for tag, value in info.items():
-        decoded = TAGS.get(tag, tag)
-        ret[decoded] = value
-    return ret
+    return exif_reader.decode_exif(info, decode_gps=False)
 
 
 def get_date_from_filename(filepath):
@@ -132,6 +122,25 @@ def get_dirs(rootdir):
     return paths
 
 
+DAY_DIR_RE = re.compile(r'^\d{4}_\d{2}_\d{2}')
+
+
+# Get the YYYY_MM_DD day directories in the YYYY directories of rootdir as a dict
+# of YYYY_MM_DD -> path. A directory that has had a suffix added to its name
+# (YYYY_MM_DD-some-description) is found by the date at the start of its name.
+def get_day_dirs(rootdir):
+    day_dirs = {}
+    for year in sorted(os.listdir(rootdir)):
+        year_dir = os.path.join(rootdir, year)
+        if not os.path.isdir(year_dir):
+            continue
+        for day in sorted(os.listdir(year_dir)):
+            # sorted so that YYYY_MM_DD is found before YYYY_MM_DD-some-description
+            if day.startswith(year) and DAY_DIR_RE.match(day) and os.path.isdir(os.path.join(year_dir, day)):
+                day_dirs.setdefault(day[:10], os.path.join(year_dir, day))
+    return day_dirs
+
+
 # get all the files within and in the subdirs of rootdir. Files are returned with the path
 def get_files(rootdir):
     fullFileList = []
@@ -196,7 +205,8 @@ class File:
 
 
 class CopySet:
-    def __init__(self, src_dir, dst_dir, overwrite=False, preserve_spaces=True, delete_orig=False):
+    def __init__(self, src_dir, dst_dir, overwrite=False, preserve_spaces=True, delete_orig=False,
+                 hash_index=None, journal=None):
         self.src_dir = path_with_separator(src_dir.strip())
         self.dst_dir = path_with_separator(dst_dir.strip())
         self.get_dst_sub_dirs()
@@ -206,11 +216,22 @@ class CopySet:
         self.overwrite = overwrite
         self.preserve_spaces = preserve_spaces
         self.delete_orig = delete_orig
+        # optional HashIndex of the destination, used to skip files already anywhere in it
+        self.hash_index = hash_index
+        # optional transfer.IngestJournal, files already in it are skipped
+        self.journal = journal
 
     def get_dst_sub_dirs(self):
-        self.dirs = get_dirs(self.dst_dir)
+        self.day_dirs = get_day_dirs(self.dst_dir)
+        self.dirs = list(self.day_dirs.values())
         return self.dirs
 
+    def add_dst_dir(self, dst_dir):
+        """Adds a newly created day directory to the index"""
+        day = os.path.basename(path_without_separator(dst_dir))
+        if DAY_DIR_RE.match(day):
+            self.day_dirs.setdefault(day[:10], dst_dir)
+
     def get_src_files(self):
         self.files = get_files(self.src_dir)
         return self.files
@@ -225,49 +246,241 @@ class CopySet:
 
     def get_dst_dir(self, date):
         dst_dir = f"{self.dst_dir}{str(date.tm_year)}{os.sep}"
-        dst_dir += "%04d_%02d_%02d" % (date.tm_year, date.tm_mon, date.tm_mday)
-        already = [x for x in self.dirs if x.find(dst_dir) >= 0]
-        if already != []:
-            dst_dir = already[0]
+        day = "%04d_%02d_%02d" % (date.tm_year, date.tm_mon, date.tm_mday)
+        dst_dir = self.day_dirs.get(day, dst_dir + day)
         logger.info(f"dst_dir {dst_dir}")
         return dst_dir
 
-    def copy_files(self):
+    def get_dest_file(self, f):
+        """Returns where the file would be copied to going by its date"""
+        fileToCopy = File(f)
+        dstDir = self.get_dst_dir(fileToCopy.date)
+        if self.preserve_spaces:
+            return dstDir + os.sep + os.path.basename(f)
+        return dstDir + os.sep + os.path.basename(f).replace(" ", "_")
+
+    def resolve_dest_file(self, f, destFile):
+        """
+        Deals with the destination file already existing. Returns (destFile, copy_needed) where
+        destFile may have been renamed and copy_needed is False if the same file is already there
+        (or anywhere else in the destination when there's a hash index).
+        """
+        if self.hash_index is not None and not self.overwrite:
+            duplicate = self.hash_index.find_duplicate(f)
+            if duplicate is not None:
+                logger.info(f"Already in the destination as {duplicate}: {f}")
+                return duplicate, False
+        if not os.path.isfile(destFile):
+            logger.info(f"Copy {os.path.basename(f)} -> {destFile}")
+            return destFile, True
+        if self.overwrite:
+            logger.warning(f"Copying over destination file which already exists: {destFile}")
+            return destFile, True
+        src_hash = get_hash(f)
+        dst_hash = get_hash(destFile)
+        if src_hash == dst_hash:
+            logger.info(f"Destination file already exists and is the same: {destFile}")
+            return destFile, False
+        logger.info(f"Renaming desination file to not overwriting file with the same name: {destFile}")
+        return rename_destfile(destFile), True
+
+    def copy_file(self, f, destFile, copy_needed=True):
+        dstDir = os.path.dirname(destFile)
+        if not (os.path.isdir(dstDir)):
+            os.makedirs(dstDir, exist_ok=True)
+            self.add_dst_dir(dstDir)
+            logger.info(f"Folder for renaming: {dstDir}")
+        st = os.stat(f)
+        sha256 = None
+        if copy_needed:
+            # the source is only hashed as it is copied when the copy has to be checked before
+            # the original is deleted, otherwise the kernel can do the copy
+            sha256 = transfer.copy_file(f, destFile, want_hash=self.delete_orig)
+            if self.hash_index is not None:
+                self.hash_index.add(destFile, src=f, sha256=sha256)
+        if self.journal is not None:
+            self.journal.record(f, destFile, st.st_size, st.st_mtime, sha256)
+        if self.delete_orig:
+            if self.verify_copy(f, destFile, sha256):
+                try:
+                    os.remove(f)
+                except Exception as exc:
+                    logger.error(f"failed to delete file: {f} {str(exc)}")
+            else:
+                logger.error(f"not deleting {f}, {destFile} doesn't have the same contents")
+
+    def verify_copy(self, f, destFile, sha256=None):
+        """
+        Whether destFile has the same contents as f, sha256 is the hash of f if it is already
+        known (worked out as it was copied).
+        """
+        if not os.path.isfile(destFile) or os.path.getsize(destFile) != os.path.getsize(f):
+            return False
+        if sha256 is None:
+            sha256 = get_hash(f)
+        return get_hash(destFile) == sha256
+
+    def copy_files(self, jobs=1):
         logger.info(f"number of files {len(self.files)}")
+        if self.journal is not None:
+            todo = [f for f in self.files if not self.journal.is_done(f)]
+            logger.info(f"skipping {len(self.files) - len(todo)} files already done in journal {self.journal.path}")
+            self.files = todo
+        if jobs > 1:
+            return self.copy_files_pipelined(jobs)
         for f in self.files:
             logger.info(f)
-            fileToCopy = File(f)
-            dstDir = self.get_dst_dir(fileToCopy.date)
-            if self.preserve_spaces:
-                destFile = dstDir + os.sep + os.path.basename(f)
-            else:
-                destFile = dstDir + os.sep + os.path.basename(f).replace(" ", "_")
-            if not (os.path.isdir(dstDir)):
-                os.makedirs(dstDir)
-                logger.info(f"Folder for renaming: {dstDir}")
-            if not os.path.isfile(destFile):
-                logger.info(f"Copy {os.path.basename(f)} -> {destFile}")
-                shutil.copy(f, destFile)
-            else:
-                if self.overwrite:
-                    logger.warning(f"Copying over destination file which already exists: {destFile}")
-                    shutil.copy(f, destFile)
-                else:
-                    src_hash = get_hash(f)
-                    dst_hash = get_hash(destFile)
-                    if src_hash == dst_hash:
-                        logger.info(f"Destination file already exists and is the same: {destFile}")
-                    else:
-                        logger.info(f"Renaming desination file to not overwriting file with the same name: {destFile}")
-                        destFile = rename_destfile(destFile)
-                        shutil.copy(f, destFile)
-            if self.delete_orig:
-                if (os.path.isfile(destFile) and
-                        os.path.getsize(destFile) == os.path.getsize(f)):
-                    try:
-                        os.remove(f)
-                    except Exception as exc:
-                        logger.error(f"failed to delete file: {f} {str(exc)}")
+            destFile, copy_needed = self.resolve_dest_file(f, self.get_dest_file(f))
+            self.copy_file(f, destFile, copy_needed)
+
+    def copy_files_pipelined(self, jobs):
+        """
+        Copies the files with three stages running at the same time, each with `jobs` worker
+        threads and a bounded queue feeding it:
+            metadata - reads the EXIF date and works out the destination file
+            hash     - compares the source and destination when the destination already exists
+            copy     - copies the file (and deletes the original with -D)
+        The stages spend their time waiting on the disks or in hashlib, both of which let the
+        other threads run, so the source card and the destination are kept busy at once.
+        """
+        stats = [StageStats("metadata"), StageStats("hash"), StageStats("copy")]
+        queues = [queue.Queue(maxsize=jobs * QUEUE_DEPTH) for _ in stats]
+        done = queue.Queue()
+
+        # destination files that are on their way through the hash and copy stages, a second
+        # source file going to the same destination has to wait for the first to be copied
+        # before it can be compared with it
+        in_flight = {}
+        in_flight_lock = threading.Lock()
+
+        def claim(destFile):
+            while True:
+                with in_flight_lock:
+                    copied = in_flight.get(destFile)
+                    if copied is None:
+                        in_flight[destFile] = threading.Event()
+                        return
+                copied.wait()
+
+        def release(destFile):
+            with in_flight_lock:
+                in_flight.pop(destFile).set()
+
+        def metadata(f):
+            size = os.path.getsize(f)
+            return (f, self.get_dest_file(f), size), size
+
+        def hashing(job):
+            f, destFile, size = job
+            claim(destFile)
+            try:
+                hashed = 0
+                if os.path.isfile(destFile) and not self.overwrite:
+                    hashed = size + os.path.getsize(destFile)
+                newDestFile, copy_needed = self.resolve_dest_file(f, destFile)
+            except Exception:
+                release(destFile)
+                raise
+            if newDestFile != destFile:
+                claim(newDestFile)
+                release(destFile)
+            return (f, newDestFile, size, copy_needed), hashed
+
+        def copying(job):
+            f, destFile, size, copy_needed = job
+            try:
+                self.copy_file(f, destFile, copy_needed)
+            finally:
+                release(destFile)
+            return None, size if copy_needed else 0
+
+        works = [metadata, hashing, copying]
+        outputs = queues[1:] + [done]
+        workers = []
+        for i in range(len(stats)):
+            workers.append(_start_stage(stats[i], queues[i], outputs[i], works[i], jobs))
+
+        stop = threading.Event()
+        reporter = threading.Thread(target=_report_progress, args=(stats, stop), daemon=True)
+        reporter.start()
+        for f in self.files:
+            queues[0].put(f)
+        for _ in range(jobs):
+            queues[0].put(None)
+        for stage_workers, next_queue in zip(workers, outputs):
+            for w in stage_workers:
+                w.join()
+            for _ in range(jobs):
+                next_queue.put(None)
+        stop.set()
+        reporter.join()
+        for stage in stats:
+            logger.info(f"done {stage.report()}")
+
+
+class StageStats:
+    """Files and bytes through one stage of the pipelined copy"""
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, nbytes, error=False):
+        with self.lock:
+            self.files += 1
+            self.bytes += nbytes
+            if error:
+                self.errors += 1
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return (f"{self.name}: {self.files} files ({self.errors} errors) "
+                f"{self.files / elapsed:.1f} files/s {self.bytes / elapsed / 1e6:.1f} MB/s")
+
+
+def _start_stage(stats, in_queue, out_queue, work, jobs):
+    """
+    Starts `jobs` threads taking jobs from in_queue until they get None. Each job is passed
+    to work() which returns (result, bytes handled), results other than None go to out_queue.
+    """
+    def worker():
+        while True:
+            job = in_queue.get()
+            if job is None:
+                return
+            try:
+                result, nbytes = work(job)
+                stats.add(nbytes)
+            except Exception as exc:
+                logger.error(f"{stats.name} failed for {job}: {str(exc)}")
+                stats.add(0, error=True)
+                continue
+            if result is not None:
+                out_queue.put(result)
+
+    threads = [threading.Thread(target=worker, name=f"{stats.name}-{i}") for i in range(jobs)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def _report_progress(stats, stop):
+    while not stop.wait(PROGRESS_INTERVAL):
+        logger.info("progress " + " | ".join(stage.report() for stage in stats))
+
+
+def list_duplicates(hash_index):
+    clusters = hash_index.duplicate_clusters()
+    if len(clusters) < 1:
+        print("No duplicate files found")
+    for sha256, size, paths in clusters:
+        print(f"{sha256} {size} bytes")
+        for path in paths:
+            print(f"    {path}")
+    return 0
 
 
 def main():
@@ -281,19 +494,47 @@ def main():
     parser.add_option("-p", action="store_true", dest="preserve_spaces", default=False,
                       help="this option will stop the file names from having spaces replaced with \"_\"")
     parser.add_option("-D", action="store_true", dest="delete_orig", default=False,
-                      help="attempt to delete the original file once it has been copied")
+                      help="delete the original file once its copy has been checked to be the same")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of files worked on at once by each stage (read, hash, copy) of the copy")
+    parser.add_option("-H", "--hash-index", dest="hash_index", default=None, metavar="DBFILE",
+                      help="index of the hashes of the files in the destination (created if needed), "
+                           "files already anywhere in the destination are not copied again")
+    parser.add_option("-r", "--refresh-index", action="store_true", dest="refresh_index", default=False,
+                      help="bring the hash index up to date with the destination before copying "
+                           "(always done when the index is empty)")
+    parser.add_option("-J", "--journal", dest="journal", default=None, metavar="JOURNALFILE",
+                      help="record each file copied in JOURNALFILE, files already in it are skipped so an "
+                           "interrupted copy can be run again to carry on from where it stopped")
+    parser.add_option("--duplicates", action="store_true", dest="duplicates", default=False,
+                      help="list the sets of identical files in the destination (needs -H) instead of copying")
 
     (options, args) = parser.parse_args()
 
-    if not os.path.isdir(options.srcdir):
+    if not options.duplicates and not os.path.isdir(options.srcdir):
         logger.error(f"Error: the source directory does not exist:\n\t{options.srcdir}")
         return 1
     if not os.path.isdir(options.dstdir):
         logger.error(f"Error: the destination directory does not exist:\n\t{options.dstdir}")
         return 1
 
-    copy_set = CopySet(options.srcdir, options.dstdir, options.overwrite, options.preserve_spaces, options.delete_orig)
-    copy_set.copy_files()
+    hash_index = None
+    if options.hash_index is not None:
+        hash_index = HashIndex(options.hash_index)
+        if options.refresh_index or options.duplicates or len(hash_index) == 0:
+            changed, gone = hash_index.refresh(options.dstdir)
+            logger.info(f"hash index refreshed, {changed} new or changed files, {gone} removed")
+    elif options.duplicates:
+        logger.error("Error: --duplicates needs a hash index (-H)")
+        return 1
+
+    if options.duplicates:
+        return list_duplicates(hash_index)
+
+    copy_set = CopySet(options.srcdir, options.dstdir, options.overwrite, options.preserve_spaces, options.delete_orig,
+                       hash_index=hash_index,
+                       journal=transfer.IngestJournal(options.journal) if options.journal else None)
+    copy_set.copy_files(jobs=options.jobs)
     return 0
 
 
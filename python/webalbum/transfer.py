@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# transfer.py - copying files into the album
+#
+# copy_file() copies with os.copy_file_range() (or os.sendfile()) where the kernel supports it
+# so the data never has to come up into python, falling back to plain reads and writes when it
+# doesn't. When the caller wants the sha256 of the file it is worked out from the data as it
+# is copied, rather than reading the file again afterwards. The copy is written to a ".part"
+# file first and renamed once it is complete so an interrupted copy never looks finished.
+#
+# IngestJournal is an append-only record of the files that have been copied so that an
+# interrupted import can pick up from where it stopped.
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# bytes handed to the kernel (or read and written) at a time
+COPY_CHUNK = 8 * 1024 * 1024
+
+PART_SUFFIX = '.part'
+
+# errors meaning the kernel can't do the copy for these files, so try the next way of copying
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def _kernel_copy(src_fd, dst_fd, size):
+    """Copies as much as the kernel will copy for us, returns the number of bytes copied"""
+    copied = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                count = min(size - copied, COPY_CHUNK)
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(src_fd, dst_fd, count, copied, copied)
+                else:
+                    os.lseek(dst_fd, copied, os.SEEK_SET)
+                    sent = os.sendfile(dst_fd, src_fd, copied, count)
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError as exc:
+            if exc.errno not in UNSUPPORTED_ERRNOS:
+                raise
+        if copied >= size:
+            break
+    return copied
+
+
+def _hashing_copy(fsrc, fdst):
+    """Copies with reads and writes, returns the sha256 of everything copied"""
+    file_hash = hashlib.sha256()
+    buf = bytearray(COPY_CHUNK)
+    view = memoryview(buf)
+    while True:
+        n = fsrc.readinto(buf)
+        if not n:
+            break
+        file_hash.update(view[:n])
+        fdst.write(view[:n])
+    return file_hash.hexdigest()
+
+
+def copy_file(src, dst, want_hash=False):
+    """
+    Copies src to dst (along with its permission bits like shutil.copy). Returns the sha256 of
+    the file as a hex-string if want_hash is True, otherwise None.
+    """
+    src = str(src)
+    dst = str(dst)
+    tmp = dst + PART_SUFFIX
+    sha256 = None
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            if want_hash:
+                sha256 = _hashing_copy(fsrc, fdst)
+            else:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = _kernel_copy(fsrc.fileno(), fdst.fileno(), size)
+                if copied < size:
+                    fsrc.seek(copied)
+                    fdst.seek(copied)
+                    shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+        shutil.copymode(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return sha256
+
+
+class IngestJournal:
+    """
+    Append-only JSON lines file with one entry per source file that has been dealt with
+    (copied, or found to already be in the destination). A source file with an entry is
+    skipped as long as its size and mtime haven't changed since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.done[entry['src']] = (entry['size'], entry['mtime'])
+                    except (ValueError, KeyError):
+                        # the last line of a journal that was being written when the import stopped
+                        continue
+        self.f = open(path, 'a')
+        if self.f.tell() > 0:
+            # start on a fresh line in case the last entry was only partly written
+            self.f.write('\n')
+
+    def __len__(self):
+        return len(self.done)
+
+    def is_done(self, src):
+        try:
+            st = os.stat(src)
+        except OSError:
+            return False
+        return self.done.get(src) == (st.st_size, st.st_mtime)
+
+    def record(self, src, dst, size, mtime, sha256=None):
+        line = json.dumps({'src': src, 'dst': dst, 'size': size, 'mtime': mtime, 'sha256': sha256})
+        with self.lock:
+            self.done[src] = (size, mtime)
+            self.f.write(line + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
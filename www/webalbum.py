@@ -94,7 +94,8 @@ import cgitb
 import configparser
 
 import traceback
-import os, sys, time, pickle
+import os, sys, time, pickle, io, stat, mimetypes, fcntl, zlib, struct, mmap, calendar
+import json, math, sqlite3, functools, warnings, html, re
 import shlex, subprocess
 from subprocess import STDOUT,PIPE
 import urllib
@@ -110,11 +111,27 @@ logger.setLevel(logging.INFO)
 handler = logging.StreamHandler(sys.stderr)
 logger.addHandler(handler)
 
-fs = cgi.FieldStorage()
-keys = fs.keys()
-clearcache = True if ('clearcache' in keys) and (fs.getvalue('clearcache') == 'on') else False
-searchstr = "" if 'searchstr' not in keys else fs.getvalue('searchstr')
-video_search = "" if 'video_search' not in keys else fs.getvalue('video_search')
+def read_request(environ=os.environ):
+    """ Sets the request parameters below from the CGI environment. The built in server (see
+    serve()) renders more than one page per process and calls this for each of them """
+    global fs, keys, request_method, query_string, http_accept, clearcache, searchstr, video_search, \
+           map_view, map_tile, timeline, metrics_view, size_request
+    fs = cgi.FieldStorage(environ=environ)
+    keys = fs.keys()
+    request_method = environ.get('REQUEST_METHOD', 'GET')
+    query_string = environ.get('QUERY_STRING', '')
+    http_accept = environ.get('HTTP_ACCEPT', '')
+    clearcache = True if ('clearcache' in keys) and (fs.getvalue('clearcache') == 'on') else False
+    searchstr = "" if 'searchstr' not in keys else fs.getvalue('searchstr')
+    video_search = "" if 'video_search' not in keys else fs.getvalue('video_search')
+    map_view = "" if 'map' not in keys else fs.getvalue('map')
+    map_tile = "" if 'map_tile' not in keys else fs.getvalue('map_tile')
+    timeline = "" if 'timeline' not in keys else fs.getvalue('timeline')
+    size_request = "" if 'size' not in keys else fs.getvalue('size')
+    # FieldStorage drops parameters without a value so look for a bare "?metrics" in the query too
+    metrics_view = ('metrics' in keys) or ('metrics' in query_string.split('&'))
+
+read_request()
 
 #------ CONFIGURATION SECTION ----------
 # optional config file for the config items below
@@ -180,10 +197,652 @@ THUMBNAIL_DIR = cfg.get_str("THUMBNAIL_DIR", "/thumbnails")
 # directory where images for viewing get generated (relative to both local and web dirs)
 VIEW_DIR = cfg.get_str("VIEW_DIR", "/view")
 
+# The sizes (width and height limit in pixels) that images get scaled down to. The smallest
+# is the thumbnails (in THUMBNAIL_DIR), VIEW_SIZE is the view on an image's page (in VIEW_DIR)
+# and the others go in SIZES_DIR/<size>. Pages list them all in srcset attributes so the
+# browser picks the smallest one that's big enough for the screen, they get made the first
+# time they're asked for.
+RENDITION_SIZES = sorted(set(int(v) for v in cfg.get_str("RENDITION_SIZES", "250,500,900,1600,2560").split(",")))
+THUMBNAIL_SIZE = RENDITION_SIZES[0]
+VIEW_SIZE = cfg.get_int("VIEW_SIZE", 900)
+if VIEW_SIZE not in RENDITION_SIZES:
+    RENDITION_SIZES = sorted(RENDITION_SIZES + [VIEW_SIZE])
+SIZES_DIR = cfg.get_str("SIZES_DIR", "/sizes")
+
+# thumbnails and views are made in the first of these formats that the browser accepts (and
+# that PIL can write), otherwise JPEG. The quality used for each size and format is set with
+# THUMBNAIL_QUALITY, THUMBNAIL_WEBP_QUALITY, VIEW_AVIF_QUALITY etc
+RENDITION_FORMATS = [f.strip().lower() for f in cfg.get_str("RENDITION_FORMATS", "avif,webp").split(",") if f.strip()]
+RENDITION_QUALITY = {
+    ('thumbnail', 'jpg'): cfg.get_int("THUMBNAIL_QUALITY", 95),
+    ('thumbnail', 'webp'): cfg.get_int("THUMBNAIL_WEBP_QUALITY", 85),
+    ('thumbnail', 'avif'): cfg.get_int("THUMBNAIL_AVIF_QUALITY", 65),
+    ('view', 'jpg'): cfg.get_int("VIEW_QUALITY", 90),
+    ('view', 'webp'): cfg.get_int("VIEW_WEBP_QUALITY", 80),
+    ('view', 'avif'): cfg.get_int("VIEW_AVIF_QUALITY", 60),
+}
+
+# sqlite database holding the album-wide metadata indexes (GPS positions etc), this
+# lives in the data dir next to the thumbnails as it's just another cache
+INDEX_DB = cfg.get_str("INDEX_DB", PREVIEW_FILE_DIR+"/webalbum.db")
+
+# map tiles are split into MAP_TILE_GRID x MAP_TILE_GRID cells, photos in the same
+# cell are returned as one cluster until the map is zoomed in to MAP_MAX_CLUSTER_ZOOM
+MAP_TILE_GRID = cfg.get_int("MAP_TILE_GRID", 8)
+MAP_MAX_CLUSTER_ZOOM = cfg.get_int("MAP_MAX_CLUSTER_ZOOM", 18)
+
 # path to error images (thumbnail and view sizes) relative to PREVIEW_FILE_DIR
 ERROR_THUMBNAIL=WEB_PREVIEW_FILE_DIR+"/error_thumbnail.png"
 ERROR_VIEW=WEB_PREVIEW_FILE_DIR+"/error_view.png"
 
+# set to 1 to add a table of where the time went to the bottom of every page
+DEBUG_TIMING = cfg.get_int("DEBUG_TIMING", 0)
+
+######## Request timing
+# The slow parts of building a page are wrapped with @timed so every request can report the
+# wall time, number of calls and bytes read for each of them. The report goes out as a
+# Server-Timing header (shows up in the browser's dev tools), a log line and, with DEBUG_TIMING
+# set, a table at the bottom of the page. Times are inclusive so they don't add up to the total,
+# the rest of the total is mostly HTML assembly.
+request_timings = {}
+request_start = time.time()
+_io_bytes_seen = 0
+
+def _bytes_read():
+    """ bytes read by this process so far (linux only, 0 elsewhere) """
+    global _io_bytes_seen
+    try:
+        with open('/proc/self/io') as f:
+            io = f.read()
+    except OSError:
+        return 0
+    rchar = int(io.split('rchar:')[1].split()[0])
+    # the reads of /proc/self/io itself would otherwise be counted too
+    rchar -= _io_bytes_seen
+    _io_bytes_seen += len(io)
+    return rchar
+
+def timed(name, histogram=None):
+    """ histogram is the name of a metric to also record the time of every call in """
+    def decorate(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            start = time.time()
+            read = _bytes_read()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                timing = request_timings.setdefault(name, [0, 0.0, 0])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] += _bytes_read() - read
+                if histogram is not None:
+                    observe_metric(histogram, elapsed)
+        return timed_func
+    return decorate
+
+def reset_timings():
+    global request_start
+    request_timings.clear()
+    request_start = time.time()
+
+def get_timings():
+    """ [(name, calls, milliseconds, bytes read)] with the whole request as "total" last """
+    timings = [(name, t[0], t[1] * 1000.0, t[2]) for name, t in sorted(request_timings.items())]
+    timings.append(('total', 1, (time.time() - request_start) * 1000.0, None))
+    return timings
+
+def server_timing_header(timings):
+    metrics = []
+    for name, calls, ms, nbytes in timings:
+        metric = '%s;dur=%.1f' % (name, ms)
+        if nbytes is not None:
+            metric += ';desc="%d calls %d bytes"' % (calls, nbytes)
+        metrics.append(metric)
+    return 'Server-Timing: %s\n' % ', '.join(metrics)
+
+def log_timings(timings, path):
+    logger.info('timing %s', json.dumps({
+        'path': path,
+        'query': query_string,
+        'timings': dict((name, {'calls': calls, 'ms': round(ms, 1), 'bytes': nbytes})
+                        for name, calls, ms, nbytes in timings),
+    }, sort_keys=True))
+
+def render_timing_footer(timings):
+    out = '<br/><table id="timing" border="1" cellpadding="3">\n'
+    out += '<tr><th>timing</th><th>calls</th><th>ms</th><th>bytes read</th></tr>\n'
+    for name, calls, ms, nbytes in timings:
+        out += '<tr><td>%s</td><td align="right">%d</td><td align="right">%.1f</td><td align="right">%s</td></tr>\n' \
+               % (name, calls, ms, '' if nbytes is None else nbytes)
+    out += '</table>\n'
+    return out
+
+######## Metrics
+# Counters and histograms in the Prometheus text format, served at "?metrics". Every CGI request
+# is a process of its own so each one collects what it did in request_metrics and adds it to the
+# totals in the metrics table of the index database as it finishes, which is what adds up the
+# numbers from all the workers.
+METRICS = {
+    'webalbum_requests_total': ('counter', 'Requests by page type'),
+    'webalbum_request_seconds': ('histogram', 'Time taken to build a page by page type'),
+    'webalbum_rendition_total': ('counter', 'Thumbnails and views by rendition and result '
+                                            '(hit, miss, coalesced, timeout or failure)'),
+    'webalbum_rendition_generate_seconds': ('histogram', 'Time taken to generate a rendition'),
+    'webalbum_listing_seconds': ('histogram', 'Time taken to list a directory'),
+    'webalbum_search_seconds': ('histogram', 'Time taken by a search'),
+    'webalbum_decode_total': ('counter', 'Originals decoded by how (full, reduced, banded or refused)'),
+    'webalbum_cache_evicted_total': ('counter', 'Renditions removed to keep the cache within its budget'),
+    'webalbum_cache_evicted_bytes_total': ('counter', 'Bytes of renditions removed to keep the cache within its budget'),
+}
+
+# upper bounds of the histogram buckets, in seconds
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+request_metrics = {}
+
+def _metric_labels(labels):
+    # "le" (a histogram bucket's upper bound) goes last so the buckets of a series sort together
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items(), key=lambda kv: (kv[0] == 'le', kv[0])))
+
+def count_metric(name, value=1, **labels):
+    key = (name, _metric_labels(labels))
+    request_metrics[key] = request_metrics.get(key, 0) + value
+
+def observe_metric(name, seconds, **labels):
+    for le in METRIC_BUCKETS:
+        count_metric(name+'_bucket', 1 if seconds <= le else 0, le='%g' % le, **labels)
+    count_metric(name+'_bucket', le='+Inf', **labels)
+    count_metric(name+'_sum', seconds, **labels)
+    count_metric(name+'_count', **labels)
+
+def flush_metrics():
+    """ adds this request's metrics to the totals in the index database """
+    if len(request_metrics) == 0:
+        return
+    try:
+        db = get_index_db()
+        db.executemany("INSERT INTO metrics VALUES (?, ?, ?) "
+                       "ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value",
+                       [(name, labels, value) for (name, labels), value in request_metrics.items()])
+        db.commit()
+        request_metrics.clear()
+    except Exception as exc:
+        logger.exception(exc)
+
+def _metric_sort_key(row):
+    # histogram buckets have to come out in order of their upper bound
+    name, labels, value = row
+    le = labels.split('le="')[1].split('"')[0] if 'le="' in labels else None
+    return (name, labels.split('le="')[0], float(le) if le is not None else 0.0)
+
+def render_metrics():
+    out = "Content-type: text/plain; version=0.0.4\n\n"
+    rows = get_index_db().execute("SELECT name, labels, value FROM metrics").fetchall()
+    described = set()
+    for name, labels, value in sorted(rows, key=_metric_sort_key):
+        base = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                base = name[:-len(suffix)]
+        if base not in described and base in METRICS:
+            out += '# HELP %s %s\n# TYPE %s %s\n' % (base, METRICS[base][1], base, METRICS[base][0])
+            described.add(base)
+        out += '%s%s %s\n' % (name, '{%s}' % labels if labels else '', '%.17g' % value if value % 1 else '%d' % value)
+    return out
+
+######## Rendition generation
+# Two people opening the same new directory (or a page and a prefetch of it) would otherwise
+# both decode the same originals to make the same thumbnails. make_rendition() only lets one
+# process at a time make any one file, the others wait for it to finish and then use what it
+# made. The locks are flock()s on a FILE.lock file next to the file being made, so only the same
+# work is ever waited for and the lock goes away with the process holding it. The lock file is
+# removed (while it is still locked) once the file is made.
+
+# seconds to wait for another process making the same file before giving up on it
+RENDITION_WAIT = cfg.get_int("RENDITION_WAIT", 30)
+
+_formats_for_accept = {}
+
+def get_rendition_format():
+    """ the format ("jpg", "webp" or "avif") of the thumbnails and views for this request """
+    fmt = _formats_for_accept.get(http_accept)
+    if fmt is None:
+        accepted = []
+        for a in http_accept.lower().split(','):
+            params = a.split(';')
+            if not any(p.strip() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for p in params[1:]):
+                accepted.append(params[0].strip())
+        Image.init()
+        fmt = 'jpg'
+        for f in RENDITION_FORMATS:
+            if 'image/'+f in accepted and f.upper() in Image.SAVE:
+                fmt = f
+                break
+        _formats_for_accept[http_accept] = fmt
+    return fmt
+
+def rendition_name(size):
+    """ "thumbnail", "view" or "<size>px", what the rendition of a size is called in the metrics """
+    if size == THUMBNAIL_SIZE:
+        return 'thumbnail'
+    if size == VIEW_SIZE:
+        return 'view'
+    return '%dpx' % size
+
+def rendition_dir(size):
+    if size == THUMBNAIL_SIZE:
+        return THUMBNAIL_DIR
+    if size == VIEW_SIZE:
+        return VIEW_DIR
+    return SIZES_DIR+"/%d" % size
+
+def rendition_save_args(rendition):
+    """ the arguments for Image.save() to write a rendition in this request's format, the sizes
+    other than thumbnails use the view quality """
+    fmt = get_rendition_format()
+    quality = RENDITION_QUALITY.get((rendition, fmt), RENDITION_QUALITY[('view', fmt)])
+    # no exif is written, so the renditions carry no orientation tag for a browser to apply
+    # on top of the rotation that has already been done
+    return {'format': 'JPEG' if fmt == 'jpg' else fmt.upper(), 'quality': quality, 'exif': b''}
+
+# the transpose that turns an image with each EXIF orientation the right way up, these only
+# move pixels about so unlike rotate() there's no resampling (and 1 needs nothing doing)
+_Transpose = getattr(Image, 'Transpose', Image)
+ORIENTATION_TRANSPOSE = {
+    2: _Transpose.FLIP_LEFT_RIGHT,
+    3: _Transpose.ROTATE_180,
+    4: _Transpose.FLIP_TOP_BOTTOM,
+    5: _Transpose.TRANSPOSE,
+    6: _Transpose.ROTATE_270,
+    7: _Transpose.TRANSVERSE,
+    8: _Transpose.ROTATE_90,
+}
+
+def get_lock_dir():
+    lockdir = PREVIEW_FILE_DIR+"/locks"
+    os.makedirs(lockdir, exist_ok=True)
+    return lockdir
+
+def _rendition_lock(lockfile, deadline):
+    """ Returns (fd, waited) once lockfile is locked by this process or None if that doesn't
+    happen before deadline """
+    waited = False
+    while True:
+        fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() > deadline:
+                    os.close(fd)
+                    return None
+                waited = True
+                time.sleep(0.05)
+        try:
+            if os.stat(lockfile).st_ino == os.fstat(fd).st_ino:
+                return fd, waited
+        except FileNotFoundError:
+            pass
+        # whoever had it removed it when they were done, lock the one that's there now
+        os.close(fd)
+        waited = True
+
+def make_rendition(filepath, rendition, generate, force=False):
+    """ Makes filepath (a thumbnail or view) with generate(tmpfile) unless it already exists,
+    tmpfile gets renamed to filepath once it is complete so nobody ever sees it half written.
+    Returns True if filepath is there afterwards. """
+    fmt = os.path.splitext(filepath)[1][1:]
+    if os.path.exists(filepath) and not force:
+        count_metric('webalbum_rendition_total', rendition=rendition, format=fmt, result='hit')
+        return True
+    lockfile = filepath+".lock"
+    locked = _rendition_lock(lockfile, time.time() + RENDITION_WAIT)
+    if locked is None:
+        logger.warning("gave up waiting for %s", filepath)
+        count_metric('webalbum_rendition_total', rendition=rendition, format=fmt, result='timeout')
+        return False
+    lock, waited = locked
+    try:
+        if waited and os.path.exists(filepath):
+            # made by whoever had the lock
+            count_metric('webalbum_rendition_total', rendition=rendition, format=fmt, result='coalesced')
+            return True
+
+        start = time.time()
+        tmpfile = "%s.%d.tmp" % (filepath, os.getpid())
+        try:
+            generate(tmpfile)
+            os.replace(tmpfile, filepath)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        observe_metric('webalbum_rendition_generate_seconds', time.time() - start, rendition=rendition, format=fmt)
+        count_metric('webalbum_rendition_total', rendition=rendition, format=fmt, result='miss')
+        return True
+    finally:
+        try:
+            os.remove(lockfile)
+        except OSError:
+            pass
+        os.close(lock)
+
+######## Decoding
+# A 50 megapixel panorama takes 200MB once it's decoded, so originals are only decoded with
+# decode_image() which keeps the decoded pixels a process holds at once within DECODE_BUDGET.
+# JPEGs are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that's still big enough for
+# the rendition being made. Uncompressed images (TIFFs from scanners etc) that are too big
+# for what's left of the budget are read a band of rows at a time, each band being scaled
+# down before the next is read. Anything else that won't fit (a huge PNG or compressed TIFF)
+# isn't decoded at all and gets the error thumbnail rather than taking the worker down.
+
+# megabytes of decoded pixels a process may hold at once
+DECODE_BUDGET = cfg.get_int("DECODE_BUDGET", 512)
+
+# images with more megapixels than this are refused by decode_image() as soon as they're opened,
+# PIL itself only warns about them (reading just their headers and EXIF data is fine)
+DECODE_MAX_MEGAPIXELS = cfg.get_int("DECODE_MAX_MEGAPIXELS", 400)
+Image.MAX_IMAGE_PIXELS = DECODE_MAX_MEGAPIXELS * 1000000
+
+# bytes per pixel in the file of the uncompressed layouts that can be read in bands
+_RAW_PIXEL_BYTES = {'L': 1, 'RGB': 3, 'RGBA': 4, 'CMYK': 4, 'I;16': 2, 'I;16B': 2}
+
+_decode_in_use = 0
+
+class DecodeBudgetError(Exception):
+    pass
+
+def _pixel_bytes(mode):
+    # bytes per pixel PIL uses to hold an image of a mode in memory
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+def _decode_budget_left():
+    return DECODE_BUDGET * 1024 * 1024 - _decode_in_use
+
+def _reserve_decode(nbytes, path):
+    global _decode_in_use
+    if nbytes > _decode_budget_left():
+        count_metric('webalbum_decode_total', how='refused')
+        raise DecodeBudgetError("%s needs %dMB to decode, only %dMB of the budget is left"
+                                % (path, nbytes // 1048576, _decode_budget_left() // 1048576))
+    _decode_in_use += nbytes
+
+def _release_decode(nbytes):
+    global _decode_in_use
+    _decode_in_use -= nbytes
+
+def _can_decode_bands(src):
+    if len(src.tile) != 1:
+        return False
+    codec, extents, offset, args = src.tile[0]
+    if codec != 'raw' or tuple(extents) != (0, 0) + src.size or not isinstance(args, tuple):
+        return False
+    # rows stored top to bottom with nothing to convert
+    return args[0] == src.mode and args[0] in _RAW_PIXEL_BYTES and (len(args) < 3 or args[2] == 1)
+
+def _decode_bands(src, box, path):
+    w, h = src.size
+    codec, extents, offset, args = src.tile[0]
+    stride = args[1] or w * _RAW_PIXEL_BYTES[args[0]]
+    factor = max(1, min(w // box[0], h // box[1]))
+    reduced = Image.new(src.mode, ((w + factor - 1) // factor, (h + factor - 1) // factor))
+    reduced_bytes = reduced.size[0] * reduced.size[1] * _pixel_bytes(src.mode)
+    # a band (read in and decoded) gets half of what's left, a whole number of factor rows
+    row_bytes = stride + w * _pixel_bytes(src.mode)
+    rows = (_decode_budget_left() - reduced_bytes) // 2 // row_bytes // factor * factor
+    rows = max(factor, min(rows, h))
+    nbytes = reduced_bytes + rows * row_bytes
+    _reserve_decode(nbytes, path)
+    try:
+        for y in range(0, h, rows):
+            n = min(rows, h - y)
+            src.fp.seek(offset + y * stride)
+            band = Image.frombytes(src.mode, (w, n), src.fp.read(n * stride), 'raw', args[0], stride)
+            reduced.paste(band.reduce(factor), (0, y // factor))
+            del band
+        return reduced.resize(box, Image.BICUBIC)
+    finally:
+        _release_decode(nbytes)
+
+def decode_image(path, size):
+    """ Returns the image at path scaled down to fit in size x size (never scaled up), the
+    original's pixels are let go of before it returns. Raises DecodeBudgetError if it can't
+    be done within the budget. """
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        with Image.open(path) as src:
+            w, h = src.size
+            ratio = min(float(size) / w, float(size) / h, 1.0)
+            box = (max(1, int(round(w * ratio))), max(1, int(round(h * ratio))))
+            how = 'full'
+            if src.format == 'JPEG' and ratio < 0.5:
+                # twice the size wanted is decoded so there's still something to scale down from
+                src.draft(src.mode, (box[0] * 2, box[1] * 2))
+                how = 'reduced' if src.size != (w, h) else 'full'
+            nbytes = src.size[0] * src.size[1] * _pixel_bytes(src.mode)
+            if nbytes > _decode_budget_left() and _can_decode_bands(src):
+                count_metric('webalbum_decode_total', how='banded')
+                return _decode_bands(src, box, path)
+            _reserve_decode(nbytes, path)
+            try:
+                src.load()
+                count_metric('webalbum_decode_total', how=how)
+                return src.resize(box, Image.BICUBIC, reducing_gap=2.0)
+            finally:
+                _release_decode(nbytes)
+
+######## Prefetch
+# From an image page people nearly always click "next", so once an image page has been worked
+# out the views of the next PREFETCH_COUNT images are made by a background process (so they
+# are ready when the click comes) and the page tells the browser to prefetch them. At most
+# PREFETCH_WORKERS of those background processes run at once, any more just don't bother.
+PREFETCH_COUNT = cfg.get_int("PREFETCH_COUNT", 3)
+PREFETCH_WORKERS = cfg.get_int("PREFETCH_WORKERS", 2)
+
+def _prefetch_slot():
+    """ returns a locked fd for one of the PREFETCH_WORKERS slots or None if they're all busy """
+    for n in range(PREFETCH_WORKERS):
+        fd = os.open(get_lock_dir()+"/prefetch-%d.lock" % n, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+def run_in_background(work):
+    """ runs work() in a detached process at a lower priority, returns straight away """
+    # the children open their own
+    close_index_db()
+    try:
+        pid = os.fork()
+    except OSError as exc:
+        logger.exception(exc)
+        return
+    if pid > 0:
+        os.waitpid(pid, 0)
+        return
+    # forked twice so the web server isn't left waiting on (or for) the process doing the work
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.nice(10)
+            request_metrics.clear()
+            work()
+    finally:
+        os._exit(0)
+
+def prefetch_views(items):
+    """ makes the views of items (that don't have one yet) in a detached background process """
+    items = [i for i in items if not os.path.exists(i.view_local)]
+    if len(items) == 0:
+        return
+    def work():
+        if _prefetch_slot() is not None:
+            for item in items:
+                item.createView()
+    run_in_background(work)
+
+def render_prefetch_links(urls):
+    return ''.join('<link rel="prefetch" href="%s">\n' % url for url in urls)
+
+######## Cache budget
+# The thumbnails, views and other sizes in the data dir would otherwise only ever grow. Each
+# class of them can be given a budget (THUMBNAIL_CACHE_MB, VIEW_CACHE_MB and SIZES_CACHE_MB)
+# and once a class goes over its budget the least recently used files of it are removed until
+# it's back under CACHE_LOW_WATER of the budget, they get made again if they're asked for.
+# The renditions themselves are served straight off the disk by the web server, so what gets
+# recorded is the directory each image page or directory page is for (in the dir_access table
+# of the index), a rendition having been used as recently as the later of when it was made and
+# when its directory was last looked at. The thumbnails of the CACHE_PROTECT_DIRS most recently
+# viewed directories are never removed. The check runs in a background process at most every
+# CACHE_CHECK_INTERVAL seconds, or can be run with "webalbum --evict". Contact sheets are left
+# alone, there's only one for every hundred thumbnails.
+
+# megabytes each class of rendition may take, 0 for no limit
+CACHE_BUDGET_MB = {
+    'thumbnail': cfg.get_int("THUMBNAIL_CACHE_MB", 0),
+    'view': cfg.get_int("VIEW_CACHE_MB", 0),
+    'sizes': cfg.get_int("SIZES_CACHE_MB", 0),
+}
+CACHE_PROTECT_DIRS = cfg.get_int("CACHE_PROTECT_DIRS", 50)
+CACHE_CHECK_INTERVAL = cfg.get_int("CACHE_CHECK_INTERVAL", 600)
+CACHE_LOW_WATER = 0.9
+
+RENDITION_EXTENSIONS = ('.jpg', '.webp', '.avif')
+
+def record_access(dir_path):
+    """ notes that the images in a directory (relative to ALBUM_ROOT) have just been looked at """
+    try:
+        db = get_index_db()
+        db.execute("INSERT INTO dir_access VALUES (?, ?, 1) ON CONFLICT(path) DO UPDATE "
+                   "SET last_access = excluded.last_access, views = views + 1", (dir_path, time.time()))
+        db.commit()
+    except Exception as exc:
+        logger.exception(exc)
+
+def _cache_dirs(cache_class):
+    if cache_class == 'thumbnail':
+        return [PREVIEW_FILE_DIR+THUMBNAIL_DIR]
+    if cache_class == 'view':
+        return [PREVIEW_FILE_DIR+VIEW_DIR]
+    return [PREVIEW_FILE_DIR+rendition_dir(size) for size in RENDITION_SIZES if size not in (THUMBNAIL_SIZE, VIEW_SIZE)]
+
+def _rendition_prefix(dir_path):
+    # the start of the file names of the renditions of the images in a directory, see AlbumItem.thumbnail
+    item = AlbumItem(ALBUM_ROOT+'/'+dir_path)
+    return urllib.parse.quote(item._clean(item.path+'/'), '')
+
+def _accessed_prefix(name, accessed):
+    # the longest prefix in accessed that name starts with (the "/"s of the path are "47"s)
+    found = None
+    i = name.find('47')
+    while i >= 0:
+        if name[:i+2] in accessed:
+            found = name[:i+2]
+        i = name.find('47', i + 1)
+    return found
+
+def evict_cache():
+    """ Removes the least recently used renditions of the classes that are over their budget,
+    returns {class: (files removed, bytes removed)} """
+    # no manifests are written while renditions are being removed, see write_manifest()
+    lock = _manifest_lock(exclusive=True)
+    try:
+        accessed = {}
+        protected = set()
+        rows = get_index_db().execute("SELECT path, last_access FROM dir_access ORDER BY last_access DESC")
+        for n, (path, last_access) in enumerate(rows):
+            prefix = _rendition_prefix(path)
+            accessed[prefix] = last_access
+            if n < CACHE_PROTECT_DIRS:
+                protected.add(prefix)
+        removed = {}
+        evicted = []
+        for cache_class, budget in sorted(CACHE_BUDGET_MB.items()):
+            if budget <= 0:
+                continue
+            total = 0
+            candidates = []
+            for d in _cache_dirs(cache_class):
+                try:
+                    entries = list(os.scandir(d))
+                except FileNotFoundError:
+                    continue
+                for entry in entries:
+                    # not the EXIF/GPS files or anything half written
+                    if not entry.name.endswith(RENDITION_EXTENSIONS):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    total += st.st_size
+                    prefix = _accessed_prefix(entry.name, accessed)
+                    if cache_class == 'thumbnail' and prefix in protected:
+                        continue
+                    candidates.append((max(st.st_mtime, accessed.get(prefix, 0)), st.st_size, entry.path))
+            files = nbytes = 0
+            if total > budget * 1048576:
+                candidates.sort()
+                for used, size, path in candidates:
+                    if total <= budget * 1048576 * CACHE_LOW_WATER:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    evicted.append(os.path.basename(path))
+                    total -= size
+                    files += 1
+                    nbytes += size
+                logger.info("evicted %d %s files (%d bytes), %d bytes left", files, cache_class, nbytes, total)
+            count_metric('webalbum_cache_evicted_total', files, rendition=cache_class)
+            count_metric('webalbum_cache_evicted_bytes_total', nbytes, rendition=cache_class)
+            removed[cache_class] = (files, nbytes)
+        if len(evicted) > 0:
+            # they'd say the removed renditions are still there
+            remove_manifests(evicted)
+            os.utime(_touch(get_lock_dir()+EVICTED_STAMP))
+    finally:
+        os.close(lock)
+    flush_metrics()
+    return removed
+
+def maybe_evict_cache():
+    """ starts evict_cache() in the background if there's a budget and it hasn't been run for
+    CACHE_CHECK_INTERVAL seconds """
+    if not any(budget > 0 for budget in CACHE_BUDGET_MB.values()):
+        return
+    stamp = get_lock_dir()+"/evict.stamp"
+    try:
+        if time.time() - os.stat(stamp).st_mtime < CACHE_CHECK_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+    # touched first so nobody else starts one too
+    with open(stamp, 'a'):
+        os.utime(stamp)
+    def work():
+        fd = os.open(get_lock_dir()+"/evict.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        evict_cache()
+    run_in_background(work)
+
 #print("Content-type: text/html\n\n")
 #print("<html><h1>WebAlbum</h1><p>{} {} {}</p></html>".format(GMAPS_API_KEY, ALBUM_ROOT, PREVIEW_FILE_DIR))
 #sys.exit(0)
@@ -192,9 +851,13 @@ class AlbumItem(object):
     def __init__(self, path): # path is the full path of the dir or file on the webserver
         self._set_path(path)
         self._text = self._get_url()
-        self._im = None
         self._exif_data = None
+        self._meta = None
         self._gps = None
+        # {format: set of sizes made} for the formats the manifest knows about, see read_manifest()
+        self._renditions = None
+        self._renditions_added = False
+        self._manifest_entry = None
 
     def _get_path(self):
         return self._path
@@ -252,176 +915,170 @@ class AlbumItem(object):
             cleaned = cleaned.replace(chars[i], "%d" % ord(chars[i]))
         return cleaned
 
-    def _get_im(self):
-        if self._im is None:
-            self._im = Image.open(self.fullpath)
-        return self._im
-    im = property(_get_im)
-
     def _get_thumbnail(self):
-        return urllib.parse.quote(self._clean(self._path),'')+".jpg"
+        return urllib.parse.quote(self._clean(self._path),'')+"."+get_rendition_format()
     thumbnail = property(_get_thumbnail)
 
     def _get_thumbnail_local(self):
         # returns full local file path
-        return PREVIEW_FILE_DIR+THUMBNAIL_DIR+"/"+self._get_thumbnail()
+        return self.sized_local(THUMBNAIL_SIZE)
     thumbnail_local = property(_get_thumbnail_local)
 
     def _get_thumbnail_web(self):
         # returns the web server relative path to the file
-        return WEB_PREVIEW_FILE_DIR+THUMBNAIL_DIR+"/"+self._get_thumbnail()
+        return self.sized_web(THUMBNAIL_SIZE)
     thumbnail_web = property(_get_thumbnail_web)
 
-    def _translate_exif_orientation(self, orientation):
-        if orientation == 3:
-            return 180
-        elif orientation == 6:
-            return 270
-        elif orientation == 8:
-            return 90
-        return 0
-
-    def _fix_orientation(self):
-        orientation = int(self.exif_data.setdefault("Orientation", 0))
-        if orientation == 0:
-            return
-        elif orientation == 3:
-            self._im = self.im.rotate(180, expand=True)
-        elif orientation == 6:
-            self._im = self.im.rotate(270, expand=True)
-        elif orientation == 8:
-            self._im = self.im.rotate(90, expand=True)
-
+    def sized_local(self, size):
+        # full local file path of the rendition of a size
+        return PREVIEW_FILE_DIR+rendition_dir(size)+"/"+self._get_thumbnail()
+
+    def sized_web(self, size):
+        # web server relative path of the rendition of a size
+        return WEB_PREVIEW_FILE_DIR+rendition_dir(size)+"/"+self._get_thumbnail()
+
+    def rendition_made(self, size):
+        # whether the rendition of a size has been made (in this request's format), taken from
+        # the directory manifest when the item came from one
+        fmt = get_rendition_format()
+        if self._renditions is not None and fmt in self._renditions:
+            return size in self._renditions[fmt]
+        return os.path.exists(self.sized_local(size))
+
+    def sized_url(self, size):
+        # the rendition itself if it has been made, otherwise the url that makes it
+        if self.rendition_made(size):
+            return self.sized_web(size)
+        return URL_BASE+"?path="+escape_path(self._path)+"&size=%d" % size
+
+    def srcset(self, sizes):
+        return ", ".join("%s %dw" % (self.sized_url(size), size) for size in sizes)
+
+    def _fix_orientation(self, im, orientation):
+        # returns im (already scaled down) the right way up
+        method = ORIENTATION_TRANSPOSE.get(orientation)
+        if method is None:
+            return im
+        return im.transpose(method)
+
+    @timed('thumbnail')
     def createThumbnail(self, force=False):
-        thumbfile = self.thumbnail_local
+        return self.createSized(THUMBNAIL_SIZE, force=force)
+
+    def createSized(self, size, force=False):
+        """ Makes the rendition that fits in size x size. It is scaled down from the next bigger
+        rendition if that has already been made (which is a lot quicker than decoding the
+        original again and again for each size) otherwise from the original. """
+        filepath = self.sized_local(size)
+        rendition = rendition_name(size)
+        generated = []
+        def generate(tmpfile):
+            bigger = [s for s in RENDITION_SIZES if s > size and os.path.exists(self.sized_local(s))]
+            if len(bigger) > 0 and not force:
+                im = decode_image(self.sized_local(bigger[0]), size)
+            else:
+                im = self._fix_orientation(decode_image(self.fullpath, size), self.orientation)
+            # conversion sometimes needed when the original is a PNG (for example)
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            im.save(tmpfile, **rendition_save_args(rendition))
+            generated.append(tmpfile)
         try:
-            if (not os.path.exists(thumbfile)) or force:
-                size = 250,250
-                self.im.thumbnail(size)
-                self._fix_orientation()
-                # conversion sometimes needed when the original is a PNG (for example)
-                if self.im.mode != "RGB":
-                    self._im = self.im.convert("RGB")
-                self.im.save(thumbfile, "JPEG", quality=95)
-            return os.path.exists(thumbfile)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            made = make_rendition(filepath, rendition, generate, force=force)
+            fmt = get_rendition_format()
+            if made and self._renditions is not None and fmt in self._renditions and size not in self._renditions[fmt]:
+                # the manifest needs writing again
+                self._renditions[fmt].add(size)
+                self._renditions_added = True
+            if generated:
+                # its directory's manifest would say it still isn't there when it's made for
+                # anything else (warming, prefetching, ?size= etc), a directory page making it
+                # writes the manifest again anyway
+                remove_manifest(AlbumItem(ALBUM_ROOT+'/'+self.parentdir))
+            return made
         except Exception as exc:
-            logger.exception(exc)
+            if isinstance(exc, (DecodeBudgetError, Image.DecompressionBombError, Image.DecompressionBombWarning)):
+                logger.warning("%s", exc)
+            else:
+                logger.exception(exc)
+            count_metric('webalbum_rendition_total', rendition=rendition, format=get_rendition_format(), result='failure')
             return False
 
     def _get_exif_data(self):
+        # the raw EXIF data, only wanted when the .meta file is (re)made
         try:
             if self._exif_data is None:
-                self._exif_data = get_exif_data(self.im)
+                # only the headers are read, the pixels are never decoded here
+                with Image.open(self.fullpath) as im:
+                    self._exif_data = get_exif_data(im)
         except:
             logger.warning("No exif info for %s", self.fullpath)
             self._exif_data = {}
         return self._exif_data
     exif_data = property(_get_exif_data)
 
-    def _get_orientation(self):
-        if self._exif_data is None:
+    def _get_meta(self):
+        # the metadata of the image the album uses, see get_image_meta()
+        if self._meta is None:
             self.LoadExif()
-        if "Orientation" in self._exif_data.keys():
-            self._orientation = self._translate_exif_orientation(self._exif_data["Orientation"])
-        else:
-            self._orientation = 0
-        return self._orientation
-    orientation = property(_get_orientation)
+        return self._meta
+    meta = property(_get_meta)
 
-    def _get_orientation_css(self):
-        tmpOr = self.orientation
-        if tmpOr == 270:
-            return 90
-        if tmpOr == 90:
-            return 270
-        return tmpOr
-    orientation_css = property(_get_orientation_css)
+    def _get_orientation(self):
+        # the EXIF orientation (1 to 8), 1 when the image doesn't have one
+        return self.meta["orientation"]
+    orientation = property(_get_orientation)
 
+    @timed('exif')
     def LoadExif(self):
-        if not self.exif_file_exists:
-            self.createExifFile()
-        else:
-            self.load_exif_data_from_file()
-        return self.exif_data
-
-    def load_exif_data_from_file(self):
-        # assume file exists
+        if self.load_meta_from_file() is None:
+            # missing, or written by another version of the schema
+            self.createExifFile(force=True)
+        if self._meta is None:
+            # the EXIF data couldn't be made sense of
+            self._set_meta(get_image_meta({}))
+        return self._meta
+
+    def load_meta_from_file(self):
         try:
-            if not os.path.isfile(self.exif_file_local):
-                logger.warning("Exif file doesn't exist: %s", self.exif_file_local)
-                return None
-            with open(self.exif_file_local, mode='rb') as ef:
-                self._exif_data = pickle.load(ef)
-            self.load_gps_from_file()
-            return self._exif_data
-        except Exception as exc:
-            logger.exception(exc)
+            meta = read_meta_file(self.meta_file_local)
+        except FileNotFoundError:
             return None
-
-    def _get_exif_file(self):
-        return urllib.parse.quote(self._clean(self._path),'')+".exif"
-    exif_file = property(_get_exif_file)
-
-    def _get_exif_file_local(self):
-        # returns the image exif data file
-        return PREVIEW_FILE_DIR+THUMBNAIL_DIR+"/"+self._get_exif_file()
-    exif_file_local = property(_get_exif_file_local)
-
-    def createExifFile(self, force=False):
-        exiffile = self.exif_file_local
-        try:
-            if (not os.path.isfile(exiffile)) or force:
-                with open(exiffile, mode='wb') as ef:
-                    pickle.dump(self.exif_data, ef)
-                self.createGpsFile(force=force)
-            return os.path.isfile(exiffile)
-        except Exception as exc:
-            logger.exception(exc)
-            return False
-
-    def _get_exif_file_exists(self):
-        return os.path.isfile(self.exif_file_local)
-    exif_file_exists = property(_get_exif_file_exists)
-
-    def load_gps_from_file(self):
-        try:
-            if not self.gps_file_exists:
-                logger.warning("GPS file not found: %s", self.gps_file_local)
-                return None
-            with open(self.gps_file_local, mode='rb') as gf:
-                self._gps = pickle.load(gf)
-            return self._gps
         except Exception as exc:
-            logger.exception(exc)
+            logger.warning("Unreadable metadata file %s: %s", self.meta_file_local, exc)
+            return None
+        if meta is None:
             return None
+        self._set_meta(meta)
+        return meta
 
-    def _get_gps_file(self):
-        return urllib.parse.quote(self._clean(self._path),'')+".gps"
-    gps_file = property(_get_gps_file)
+    def _set_meta(self, meta):
+        self._meta = meta
+        self._gps = tuple(meta["gps"]) if meta["gps"] is not None else None
 
-    def _get_gps_file_local(self):
-        # returns the image exif data file
-        return PREVIEW_FILE_DIR+THUMBNAIL_DIR+"/"+self._get_gps_file()
-    gps_file_local = property(_get_gps_file_local)
+    def _get_meta_file(self):
+        return urllib.parse.quote(self._clean(self._path),'')+META_EXTENSION
+    meta_file = property(_get_meta_file)
 
-    def createGpsFile(self, force=False):
-        gpsfile = self.gps_file_local
+    def _get_meta_file_local(self):
+        # returns the image metadata file
+        return PREVIEW_FILE_DIR+THUMBNAIL_DIR+"/"+self._get_meta_file()
+    meta_file_local = property(_get_meta_file_local)
+
+    def createExifFile(self, force=False):
+        metafile = self.meta_file_local
         try:
-            if (not os.path.exists(gpsfile)) or force:
-                self._gps = get_lat_lon(self.exif_data)
-                if self._gps[0] is None or self._gps[1] is None:
-                    return False
-                with open(gpsfile, mode='wb') as gf:
-                    pickle.dump(self._gps, gf)
-            return os.path.exists(gpsfile)
+            if (not os.path.isfile(metafile)) or force:
+                self._set_meta(get_image_meta(self.exif_data))
+                write_meta_file(metafile, self._meta)
+                index_taken(self)
+                index_gps(self)
+            return os.path.isfile(metafile)
         except Exception as exc:
             logger.exception(exc)
             return False
 
-    def _get_gps_file_exists(self):
-        return os.path.isfile(self.gps_file_local)
-    gps_file_exists = property(_get_gps_file_exists)
-
     def _get_gps(self):
         return self._gps
     gps = property(_get_gps)
@@ -432,34 +1089,22 @@ class AlbumItem(object):
                (self._gps[1] is not None)
     haveGps = property(_get_haveGps)
 
+    @timed('view')
     def createView(self, force=False):
-        viewFile = self.view_local
-        try:
-            if (not os.path.exists(viewFile)) or force:
-                size = 900,900
-                self.im.thumbnail(size)
-                self._fix_orientation()
-                # conversion sometimes needed when the original is a PNG (for example)
-                if self.im.mode != "RGB":
-                    self._im = self.im.convert("RGB")
-                self.im.save(viewFile, "JPEG", quality=90)
-            return os.path.exists(viewFile)
-        except Exception as exc:
-            logger.exception(exc)
-            return False
+        return self.createSized(VIEW_SIZE, force=force)
 
     def _get_view(self):
-        return urllib.parse.quote(self._clean(self._path),'')+".jpg"
+        return urllib.parse.quote(self._clean(self._path),'')+"."+get_rendition_format()
     view = property(_get_view)
 
     def _get_view_local(self):
         # returns full local file path
-        return PREVIEW_FILE_DIR+VIEW_DIR+"/"+self._get_view()
+        return self.sized_local(VIEW_SIZE)
     view_local = property(_get_view_local)
 
     def _get_view_web(self):
         # returns the web server relative path to the file
-        return WEB_PREVIEW_FILE_DIR+VIEW_DIR+"/"+self._get_view()
+        return self.sized_web(VIEW_SIZE)
     view_web = property(_get_view_web)
 
     def _get_web_original(self):
@@ -527,6 +1172,391 @@ def get_lat_lon(exif_data):
 
     return lat, lon
 
+######## Image metadata
+# What the album uses from an image's EXIF data is kept in a small JSON file next to its
+# thumbnails (one line, eg {"v":1,"orientation":6,"taken":"2019-03-01 10:12:00",
+# "gps":[-33.8,151.2],"width":4000,"height":3000}). The raw EXIF data used to be pickled
+# into .exif and .gps files instead, which meant unpickling files from the writable data
+# directory and spending most of the time on MakerNote blobs and IFDRational objects that
+# nothing looks at. "webalbum --convert-sidecars" turns the old files into .meta files.
+
+# bumped whenever the fields change, files of any other version are made again from the image
+META_VERSION = 1
+META_EXTENSION = ".meta"
+META_FIELDS = ("orientation", "taken", "gps", "width", "height")
+LEGACY_SIDECARS = (".exif", ".gps")
+
+# the only classes the raw EXIF data of the old .exif/.gps files are made of
+LEGACY_PICKLE_CLASSES = {
+    ("PIL.TiffImagePlugin", "IFDRational"),
+    ("fractions", "Fraction"),
+}
+
+def get_image_meta(exif_data):
+    """ Returns the metadata the album uses (see META_FIELDS) from the exif_data of an image
+    (obtained through get_exif_data above) """
+    def integer(key, default):
+        try:
+            return int(exif_data.get(key, default))
+        except (TypeError, ValueError):
+            return default
+    orientation = integer("Orientation", 1)
+    lat, lon = get_lat_lon(exif_data)
+    return {
+        "v": META_VERSION,
+        "orientation": orientation if orientation in ORIENTATION_TRANSPOSE else 1,
+        "taken": get_taken(exif_data),
+        "gps": [float(lat), float(lon)] if lat is not None and lon is not None else None,
+        "width": max(0, integer("ExifImageWidth", 0)),
+        "height": max(0, integer("ExifImageHeight", 0)),
+    }
+
+def read_meta_file(metafile):
+    """ Returns the metadata in metafile or None if it was written for another META_VERSION """
+    with open(metafile, 'r') as f:
+        meta = json.loads(f.readline())
+    if not isinstance(meta, dict) or meta.get("v") != META_VERSION or any(k not in meta for k in META_FIELDS):
+        return None
+    return meta
+
+def write_meta_file(metafile, meta):
+    tmpfile = "%s.%d.tmp" % (metafile, os.getpid())
+    try:
+        with open(tmpfile, 'w') as f:
+            f.write(json.dumps(meta, separators=(',', ':')) + '\n')
+        os.replace(tmpfile, metafile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # refuses anything but plain data and LEGACY_PICKLE_CLASSES, the data directory is writable
+    def find_class(self, module, name):
+        if (module, name) not in LEGACY_PICKLE_CLASSES:
+            raise pickle.UnpicklingError("%s.%s isn't allowed in a .exif file" % (module, name))
+        return super().find_class(module, name)
+
+def convert_sidecars():
+    """ Writes a .meta file for every old pickled .exif file in the data directory (keeping
+    its mtime so it is no staler than before) and removes the .exif and .gps files. Returns
+    (converted, dropped), dropped files are made again from their image when next needed. """
+    thumbdir = PREVIEW_FILE_DIR+THUMBNAIL_DIR+"/"
+    converted = dropped = 0
+    with os.scandir(thumbdir) as it:
+        legacy = sorted(entry.name for entry in it if entry.name.endswith(LEGACY_SIDECARS))
+    for name in legacy:
+        base, ext = os.path.splitext(name)
+        if ext == ".gps":
+            # the position is worked out again from the .exif file's GPSInfo
+            os.remove(thumbdir+name)
+            continue
+        metafile = thumbdir+base+META_EXTENSION
+        try:
+            if not os.path.isfile(metafile):
+                with open(thumbdir+name, 'rb') as f:
+                    exif_data = _LegacyUnpickler(f).load()
+                if not isinstance(exif_data, dict):
+                    raise ValueError("not a dictionary of EXIF data")
+                write_meta_file(metafile, get_image_meta(exif_data))
+                st = os.stat(thumbdir+name)
+                os.utime(metafile, (st.st_atime, st.st_mtime))
+            converted += 1
+        except Exception as exc:
+            logger.warning("Dropping %s: %s", name, exc)
+            dropped += 1
+        os.remove(thumbdir+name)
+    return converted, dropped
+
+######## Album index
+# The per image .meta files are only any good for one image at a time. The index
+# database keeps the bits of metadata that get queried across the whole album so that
+# those queries don't need to crawl ALBUM_ROOT. It is filled in as the .meta files get
+# created and can be (re)built in one go with "webalbum --build-index".
+
+# each entry is applied once, in order, and the count applied is kept in user_version
+INDEX_SCHEMA = [
+    """
+    CREATE TABLE photos (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        lat REAL,
+        lon REAL
+    );
+    CREATE VIRTUAL TABLE photo_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+    """,
+    """
+    ALTER TABLE photos ADD COLUMN taken TEXT;
+    CREATE INDEX photos_taken ON photos(taken);
+    """,
+    """
+    CREATE TABLE metrics (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (name, labels)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE dirs (
+        path TEXT PRIMARY KEY,
+        mtime REAL NOT NULL,
+        images INTEGER NOT NULL,
+        videos INTEGER NOT NULL,
+        subdirs INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        cover TEXT,
+        first_taken TEXT,
+        last_taken TEXT
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE dir_access (
+        path TEXT PRIMARY KEY,
+        last_access REAL NOT NULL,
+        views INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX dir_access_last ON dir_access(last_access);
+    """,
+]
+
+_index_db = None
+
+def get_index_db():
+    global _index_db
+    if _index_db is None:
+        db = sqlite3.connect(INDEX_DB, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        if db.execute("PRAGMA user_version").fetchone()[0] < len(INDEX_SCHEMA):
+            # in one exclusive transaction so processes opening a new database at the same
+            # time (warm workers, concurrent requests) don't both apply the same entries
+            db.execute("BEGIN EXCLUSIVE")
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            for i in range(version, len(INDEX_SCHEMA)):
+                for statement in INDEX_SCHEMA[i].split(';'):
+                    if statement.strip():
+                        db.execute(statement)
+                db.execute("PRAGMA user_version = %d" % (i + 1))
+            db.commit()
+        _index_db = db
+    return _index_db
+
+def close_index_db():
+    """ closes the connection (committing whatever is outstanding), for before forking as a
+    connection mustn't be carried across fork(), the next get_index_db() opens a new one """
+    global _index_db
+    if _index_db is not None:
+        _index_db.commit()
+        _index_db.close()
+        _index_db = None
+
+def _index_photo_id(db, path):
+    db.execute("INSERT OR IGNORE INTO photos(path) VALUES (?)", (path,))
+    return db.execute("SELECT id FROM photos WHERE path = ?", (path,)).fetchone()[0]
+
+def index_gps(item, commit=True):
+    """Adds (or updates) the GPS position of an item in the album index"""
+    if not item.haveGps:
+        return False
+    try:
+        lat, lon = float(item.gps[0]), float(item.gps[1])
+        db = get_index_db()
+        photo_id = _index_photo_id(db, item.path)
+        db.execute("UPDATE photos SET lat = ?, lon = ? WHERE id = ?", (lat, lon, photo_id))
+        db.execute("INSERT OR REPLACE INTO photo_rtree VALUES (?, ?, ?, ?, ?)",
+                   (photo_id, lat, lat, lon, lon))
+        if commit:
+            db.commit()
+        return True
+    except Exception as exc:
+        logger.exception(exc)
+        return False
+
+def get_taken(exif_data):
+    """Returns the capture time from the exif data as "YYYY-MM-DD HH:MM:SS" (so that it
+    sorts and can be grouped with substr()) or None if there isn't a usable one """
+    for key in ("DateTimeOriginal", "DateTimeDigitized", "DateTime"):
+        value = _get_if_exist(exif_data, key)
+        if not isinstance(value, str):
+            continue
+        value = value.strip().replace("-", ":")[:19]
+        try:
+            return time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(value, "%Y:%m:%d %H:%M:%S"))
+        except ValueError:
+            continue
+    return None
+
+def index_taken(item, commit=True):
+    """Adds (or updates) the capture time of an item in the album index"""
+    taken = item.meta["taken"]
+    if taken is None:
+        return False
+    try:
+        db = get_index_db()
+        photo_id = _index_photo_id(db, item.path)
+        if db.execute("UPDATE photos SET taken = ? WHERE id = ? AND taken IS NOT ?",
+                      (taken, photo_id, taken)).rowcount > 0:
+            # the capture dates (and cover) of the summaries of the directories it's in are
+            # out of date, they're made again when next wanted
+            parents = []
+            path = item.path
+            while path:
+                path = os.path.dirname(path)
+                parents.append(path)
+            db.execute("DELETE FROM dirs WHERE path IN (%s)" % ", ".join("?" * len(parents)), parents)
+        if commit:
+            db.commit()
+        return True
+    except Exception as exc:
+        logger.exception(exc)
+        return False
+
+def _taken_range(start, end=None):
+    # start and end are (partial) "YYYY-MM-DD HH:MM:SS" strings, end is inclusive so
+    # "2019-03" matches everything in March 2019, "~" sorts after all of those characters
+    return start, (start if end is None else end) + "~"
+
+def query_taken_histogram(start, end=None):
+    """Returns (period, count) pairs for the photos taken in the range, grouped by year when
+    start is empty, by month when start is a year and by day when start is a month """
+    length = {0: 4, 4: 7}.get(len(start), 10)
+    sql = "SELECT substr(taken, 1, ?) AS period, COUNT(*) FROM photos " \
+          "WHERE taken >= ? AND taken < ? GROUP BY period ORDER BY period"
+    return get_index_db().execute(sql, (length,) + _taken_range(start, end)).fetchall()
+
+def query_taken_items(start, end=None, limit=None):
+    """Returns (path, taken) of the photos taken in the range in capture time order"""
+    sql = "SELECT path, taken FROM photos WHERE taken >= ? AND taken < ? ORDER BY taken, path"
+    args = list(_taken_range(start, end))
+    if limit is not None:
+        sql += " LIMIT ?"
+        args.append(int(limit))
+    return get_index_db().execute(sql, args).fetchall()
+
+def query_gps_bbox(south, west, north, east, limit=None):
+    """Returns (path, lat, lon) of every indexed photo inside the bounding box"""
+    sql = "SELECT p.path, p.lat, p.lon FROM photo_rtree r JOIN photos p ON p.id = r.id " \
+          "WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ? ORDER BY p.path"
+    args = [south, north, west, east]
+    if limit is not None:
+        sql += " LIMIT ?"
+        args.append(int(limit))
+    return get_index_db().execute(sql, args).fetchall()
+
+def tile_bounds(z, x, y):
+    """Returns (south, west, north, east) of a web mercator (slippy map) tile"""
+    n = 2.0 ** z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+def query_gps_tile(z, x, y):
+    """Returns the photos in a map tile aggregated into a MAP_TILE_GRID x MAP_TILE_GRID
+    grid of clusters, each one being [lat, lon, count, path of the first photo]. Once
+    the zoom reaches MAP_MAX_CLUSTER_ZOOM the photos are only grouped by exact position """
+    south, west, north, east = tile_bounds(z, x, y)
+    if z >= MAP_MAX_CLUSTER_ZOOM:
+        cell = "p.lat, p.lon"
+    else:
+        cell = "CAST((p.lat - %r) * %r AS INTEGER), CAST((p.lon - %r) * %r AS INTEGER)" % \
+               (south, MAP_TILE_GRID / (north - south), west, MAP_TILE_GRID / (east - west))
+    sql = "SELECT AVG(p.lat), AVG(p.lon), COUNT(*), MIN(p.path) FROM photo_rtree r " \
+          "JOIN photos p ON p.id = r.id " \
+          "WHERE r.min_lat >= ? AND r.max_lat < ? AND r.min_lon >= ? AND r.max_lon < ? " \
+          "GROUP BY %s" % cell
+    rows = get_index_db().execute(sql, (south, north, west, east)).fetchall()
+    return [[round(lat, 6), round(lon, 6), count, path] for lat, lon, count, path in rows]
+
+def build_album_index():
+    """Walks the whole album loading (or creating) the exif and gps files for every
+    image and puts what's found (capture time, gps position) into the index """
+    db = get_index_db()
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(ALBUM_ROOT):
+        dirnames.sort()
+        for f in sorted(filenames):
+            fullpath = os.path.join(dirpath, f)
+            if not filter_is_valid_file(fullpath):
+                continue
+            item = AlbumItem(fullpath)
+            item.LoadExif()
+            index_taken(item, commit=False)
+            if index_gps(item, commit=False):
+                count += 1
+        db.commit()
+    # bottom up so the covers and capture times of the subdirectories are there for their parents
+    for dirpath, dirnames, filenames in os.walk(ALBUM_ROOT, topdown=False):
+        get_dir_summaries([AlbumItem(dirpath)], force=True)
+    logger.info("indexed %d photos with gps positions", count)
+    return count
+
+######## Directory summaries
+# What's in each directory (the number of images, videos and subdirectories directly in it and
+# the bytes they take), the image to show for it and the capture times of everything under it
+# are kept in the dirs table of the index, so a page of directories can show a tile for each
+# one from a single query rather than listing every one of them. A summary is made again when
+# the mtime of its directory changes. The capture times come from the photos table, so they're
+# only complete once the images have been indexed (see --build-index).
+
+# set to 0 to show the directories on a page as plain links rather than tiles
+DIR_TILES = cfg.get_int("DIR_TILES", 1)
+
+DIR_SUMMARY_COLUMNS = ('path', 'mtime', 'images', 'videos', 'subdirs', 'bytes', 'cover', 'first_taken', 'last_taken')
+
+def _make_dir_summary(item, mtime):
+    dirs, files, videos = GetFilesAndDirs(item.path)
+    nbytes = 0
+    for f in files + videos:
+        try:
+            nbytes += os.stat(f.fullpath).st_size
+        except OSError:
+            pass
+    cover = files[0].path if len(files) > 0 else None
+    if cover is None:
+        # a directory of directories (a year) shows the cover of the first one that has one
+        for d in dirs:
+            summary = get_dir_summaries([d]).get(d.path)
+            if summary is not None and summary['cover'] is not None:
+                cover = summary['cover']
+                break
+    under = (item.path+"/", item.path+"0") if item.path else ("", "\uffff")
+    first_taken, last_taken = get_index_db().execute(
+        "SELECT MIN(taken), MAX(taken) FROM photos WHERE path >= ? AND path < ?", under).fetchone()
+    return dict(zip(DIR_SUMMARY_COLUMNS, (item.path, mtime, len(files), len(videos), len(dirs), nbytes,
+                                          cover, first_taken, last_taken)))
+
+@timed('summaries')
+def get_dir_summaries(items, force=False):
+    """ Returns {path: summary} for the directories in items, each summary being a dict with
+    the DIR_SUMMARY_COLUMNS. Only the directories that have changed since their summaries
+    were made get listed, the rest just get a stat. """
+    db = get_index_db()
+    known = {}
+    paths = [d.path for d in items]
+    for i in range(0, len(paths), 500):
+        chunk = paths[i:i+500]
+        for row in db.execute("SELECT %s FROM dirs WHERE path IN (%s)"
+                              % (", ".join(DIR_SUMMARY_COLUMNS), ", ".join("?" * len(chunk))), chunk):
+            known[row[0]] = dict(zip(DIR_SUMMARY_COLUMNS, row))
+    summaries = {}
+    changed = False
+    for d in items:
+        try:
+            mtime = os.stat(d.fullpath).st_mtime
+        except OSError:
+            continue
+        summary = known.get(d.path)
+        if force or summary is None or summary['mtime'] != mtime:
+            summary = _make_dir_summary(d, mtime)
+            db.execute("INSERT OR REPLACE INTO dirs VALUES (%s)" % ", ".join("?" * len(DIR_SUMMARY_COLUMNS)),
+                       tuple(summary[c] for c in DIR_SUMMARY_COLUMNS))
+            changed = True
+        summaries[d.path] = summary
+    if changed:
+        db.commit()
+    return summaries
+
 
 ################
 # Example ######
@@ -613,7 +1643,7 @@ def filter_is_valid_file(path):
     if not os.path.isfile(path):
         return False
     basename = os.path.basename(path)
-    for ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
+    for ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff']:
         if basename.lower().endswith(ext):
             return True
     return False
@@ -642,6 +1672,7 @@ def separate_files(fullPaths):
 
     return sortedDirs, sortedFiles, sortedVideos
 
+@timed('listing', 'webalbum_listing_seconds')
 def GetFilesAndDirs(subDir):
     if subDir.endswith("/"):
        subDir = subDir[:-1]
@@ -655,6 +1686,231 @@ def GetFilesAndDirs(subDir):
     fullPaths = [path+d for d in contents]
     return separate_files(fullPaths)
 
+######## Directory manifests
+# A directory page would otherwise stat every entry of the directory, read the .meta file
+# of every image and check its thumbnail is there. What the page needs of them (name,
+# size, mtime, dimensions, orientation, GPS position, capture time and which renditions have
+# been made) is written to a manifest per directory in MANIFEST_DIR under the data dir instead:
+# a header followed by one fixed size record per entry and then the names, read with a single
+# mmap. A manifest is only used while the directory's mtime is the one it was written for (and
+# RENDITION_SIZES hasn't changed), the records of the files that haven't changed are reused
+# when it's written again.
+MANIFEST_DIR = cfg.get_str("MANIFEST_DIR", "/manifests")
+
+MANIFEST_MAGIC = b'WAM1'
+# magic, directory mtime, crc of RENDITION_SIZES, formats covered, entries, bytes of names
+MANIFEST_HEADER = struct.Struct('<4sdIIII')
+# kind, orientation, flags, name offset, name length, size, mtime, width, height, lat, lon,
+# capture time (seconds, as if it were UTC), renditions made (a bit per size per format)
+MANIFEST_ENTRY = struct.Struct('<BBHIIQdIIddqI')
+MANIFEST_KINDS = ('dir', 'image', 'video')
+MANIFEST_FORMATS = ('jpg', 'webp', 'avif')
+MANIFEST_HAS_GPS = 1
+MANIFEST_HAS_TAKEN = 2
+
+# lock (shared by pages writing manifests, exclusive while evict_cache() runs) and the file
+# evict_cache() touches once it's done, both in the lock dir
+MANIFEST_LOCK = "/manifest.lock"
+EVICTED_STAMP = "/evicted.stamp"
+
+def _touch(filepath):
+    with open(filepath, 'a'):
+        pass
+    return filepath
+
+def _manifest_lock(exclusive=False):
+    """ returns the locked fd of MANIFEST_LOCK, shared locks aren't waited for (None if it's
+    held exclusively) """
+    fd = os.open(get_lock_dir()+MANIFEST_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return fd
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+def manifest_path(dirItem):
+    return PREVIEW_FILE_DIR+MANIFEST_DIR+"/dir"+urllib.parse.quote(dirItem._clean("/"+dirItem.path), '')+".wam"
+
+def _manifest_sizes_crc():
+    return zlib.crc32(",".join(str(size) for size in RENDITION_SIZES).encode('ascii'))
+
+def _load_manifest(dirItem):
+    """ (header, [(name, entry)]) from dirItem's manifest whatever its mtime, or None """
+    try:
+        with open(manifest_path(dirItem), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            header = MANIFEST_HEADER.unpack_from(m, 0)
+            magic, mtime, sizes_crc, formats, count, names_length = header
+            if magic != MANIFEST_MAGIC or sizes_crc != _manifest_sizes_crc():
+                return None
+            names_at = MANIFEST_HEADER.size + count * MANIFEST_ENTRY.size
+            names = m[names_at:names_at+names_length]
+            entries = list(MANIFEST_ENTRY.iter_unpack(m[MANIFEST_HEADER.size:names_at]))
+    except (OSError, ValueError, struct.error):
+        return None
+    return header, [(names[e[3]:e[3]+e[4]].decode('utf-8', 'surrogateescape'), e) for e in entries]
+
+def list_dir(dirItem):
+    """ GetFilesAndDirs() for an AlbumItem, from its manifest if it has an up to date one """
+    listing = read_manifest(dirItem)
+    return listing if listing is not None else GetFilesAndDirs(dirItem.path)
+
+@timed('listing', 'webalbum_listing_seconds')
+def read_manifest(dirItem):
+    """ Returns (dirs, files, videos) like GetFilesAndDirs() from dirItem's manifest, with the
+    GPS positions and renditions of the files filled in, or None if it's out of date """
+    loaded = _load_manifest(dirItem)
+    if loaded is None:
+        return None
+    (magic, mtime, sizes_crc, formats, count, names_length), entries = loaded
+    try:
+        if os.stat(dirItem.fullpath).st_mtime != mtime:
+            return None
+    except OSError:
+        return None
+    listing = ([], [], [])
+    prefix = dirItem.fullpath+"/"
+    for name, entry in entries:
+        item = AlbumItem(prefix+name)
+        kind, orientation, flags, name_at, name_length, size, mtime, width, height, lat, lon, taken, made = entry
+        if MANIFEST_KINDS[kind] == 'image':
+            item._manifest_entry = entry
+            item._set_meta({
+                "v": META_VERSION,
+                "orientation": orientation,
+                "taken": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(taken)) if flags & MANIFEST_HAS_TAKEN else None,
+                "gps": [lat, lon] if flags & MANIFEST_HAS_GPS else None,
+                "width": width,
+                "height": height,
+            })
+            item._renditions = {}
+            for f, fmt in enumerate(MANIFEST_FORMATS):
+                if formats & (1 << f):
+                    item._renditions[fmt] = set(size for s, size in enumerate(RENDITION_SIZES)
+                                                if made & (1 << (s * len(MANIFEST_FORMATS) + f)))
+        listing[kind].append(item)
+    return listing
+
+def manifest_out_of_date(files):
+    """ whether renditions have been made for files (read from a manifest) since the manifest
+    was written or it doesn't cover this request's format """
+    fmt = get_rendition_format()
+    return any(f._renditions_added or f._renditions is None or fmt not in f._renditions for f in files)
+
+def _manifest_image_entry(item, st):
+    # everything but the name and renditions made
+    meta = item.meta
+    flags = 0
+    lat = lon = 0.0
+    if item.haveGps:
+        flags |= MANIFEST_HAS_GPS
+        lat, lon = float(item.gps[0]), float(item.gps[1])
+    taken = meta["taken"]
+    if taken is not None:
+        flags |= MANIFEST_HAS_TAKEN
+        taken = calendar.timegm(time.strptime(taken, "%Y-%m-%d %H:%M:%S"))
+    return [MANIFEST_KINDS.index('image'), meta["orientation"], flags, 0, 0, st.st_size, st.st_mtime,
+            meta["width"], meta["height"], lat, lon, taken or 0, 0]
+
+def write_manifest(dirItem, dirs, files, videos, since):
+    """ writes dirItem's manifest from its listing (worked out from time since on), the
+    renditions of files in this request's format are the ones the page found (or made) """
+    fmt = get_rendition_format()
+    lock = _manifest_lock()
+    if lock is None:
+        # renditions are being removed, the next page can write it
+        return
+    try:
+        mtime = os.stat(dirItem.fullpath).st_mtime
+        loaded = _load_manifest(dirItem)
+        old = {}
+        formats = 0
+        if loaded is not None:
+            old = dict(loaded[1])
+            if loaded[0][1] == mtime:
+                # still the same directory, what's known about the other formats still holds
+                formats = loaded[0][3]
+        formats |= 1 << MANIFEST_FORMATS.index(fmt)
+        records = []
+        names = bytearray()
+        for kind, items in enumerate((dirs, files, videos)):
+            for item in items:
+                name = item.basename.encode('utf-8', 'surrogateescape')
+                if MANIFEST_KINDS[kind] == 'dir':
+                    entry = [kind, 0, 0, 0, 0, 0, 0.0, 0, 0, 0.0, 0.0, 0, 0]
+                else:
+                    st = os.stat(item.fullpath)
+                    previous = old.get(item.basename)
+                    if previous is not None and previous[0] == kind and previous[5:7] == (st.st_size, st.st_mtime):
+                        entry = list(previous)
+                    elif MANIFEST_KINDS[kind] == 'image':
+                        entry = _manifest_image_entry(item, st)
+                    else:
+                        entry = [kind, 0, 0, 0, 0, st.st_size, st.st_mtime, 0, 0, 0.0, 0.0, 0, 0]
+                if MANIFEST_KINDS[kind] == 'image':
+                    made = 0
+                    for f, other in enumerate(MANIFEST_FORMATS):
+                        if not formats & (1 << f):
+                            continue
+                        known = item._renditions.get(other) if item._renditions is not None else None
+                        for s, size in enumerate(RENDITION_SIZES):
+                            if (size in known) if known is not None else (other == fmt and item.rendition_made(size)):
+                                made |= 1 << (s * len(MANIFEST_FORMATS) + f)
+                    entry[12] = made
+                entry[3:5] = [len(names), len(name)]
+                names += name
+                records.append(MANIFEST_ENTRY.pack(*entry))
+        header = MANIFEST_HEADER.pack(MANIFEST_MAGIC, mtime, _manifest_sizes_crc(), formats, len(records), len(names))
+        filepath = manifest_path(dirItem)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmpfile = "%s.%d.tmp" % (filepath, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            f.write(header + b''.join(records) + bytes(names))
+        os.replace(tmpfile, filepath)
+        try:
+            # renditions the listing said were made may have been removed since (the second
+            # is for the granularity of the file system's timestamps)
+            if os.stat(get_lock_dir()+EVICTED_STAMP).st_mtime >= since - 1:
+                os.remove(filepath)
+        except FileNotFoundError:
+            pass
+    except Exception as exc:
+        logger.exception(exc)
+    finally:
+        os.close(lock)
+
+def remove_manifest(dirItem):
+    """ throws away dirItem's manifest, for when renditions of its files have been made or
+    removed by something other than its directory page """
+    try:
+        os.remove(manifest_path(dirItem))
+    except OSError:
+        pass
+
+def remove_manifests(renditions=None):
+    """ throws away the manifests of the directories the renditions (file names) could be of,
+    or every manifest """
+    try:
+        entries = list(os.scandir(PREVIEW_FILE_DIR+MANIFEST_DIR))
+    except FileNotFoundError:
+        return
+    if renditions is not None:
+        # the renditions of the files of a directory start with its name followed by a "/"
+        # (cleaned to "47"), a "47" that's part of a name just throws away one more manifest
+        dirs = set([""])
+        for name in renditions:
+            i = name.find('47')
+            while i >= 0:
+                dirs.add(name[:i])
+                i = name.find('47', i + 1)
+        wanted = set("dir47"+d+".wam" for d in dirs)
+        entries = [entry for entry in entries if entry.name in wanted]
+    for entry in entries:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
 
 def HTML_Header(page_title):
     out = "Content-type: text/html\n\n"
@@ -699,36 +1955,12 @@ def HTML_Header_Thin():
 <html>
     <head>
         <meta http-equiv="X-UA-Compatible" content="IE=7">
-        <style type="text/css">
-            .rotate90 {
-                -webkit-transform: rotate(90deg);
-                -moz-transform: rotate(90deg);
-                -o-transform: rotate(90deg);
-                -ms-transform: rotate(90deg);
-                transform: rotate(90deg);
-            }
-             .rotate180 {
-                -webkit-transform: rotate(180deg);
-                -moz-transform: rotate(180deg);
-                -o-transform: rotate(180deg);
-                -ms-transform: rotate(180deg);
-                transform: rotate(180deg);
-            }
-              .rotate270 {
-                -webkit-transform: rotate(270deg);
-                -moz-transform: rotate(270deg);
-                -o-transform: rotate(270deg);
-                -ms-transform: rotate(270deg);
-                transform: rotate(270deg);
-            }
-        </style>
         <title>Image Only</title>
     </head>
     <body>
 """
 
-def HTML_Footer_Thin(orientation=0):
-    orientation = int(orientation)
+def HTML_Footer_Thin():
     out = """
 <script type="text/javascript">
 window.onload = function() { doResize(); }
@@ -768,7 +2000,7 @@ function doResize(){
     return out
 
 def GetRequestMethod():
-    return os.environ['REQUEST_METHOD']
+    return request_method
 
 def get_path():
     path = urllib.parse.unquote(fs.getvalue("path") if 'path' in keys else "")
@@ -820,7 +2052,7 @@ function cb_cache_click() {
 def render_parent_prev_next(item):
     tmpitem = AlbumItem(ALBUM_ROOT+'/'+item.parentdir) if item.isfile else item
     parent = AlbumItem(ALBUM_ROOT+'/'+tmpitem.parentdir)
-    siblingDirs, siblingFiles, siblingVideos = GetFilesAndDirs(parent.path)
+    siblingDirs, siblingFiles, siblingVideos = list_dir(parent)
     dirIndex = get_item_index(tmpitem, siblingDirs)
     parent.text = 'Parent Directory'
 
@@ -839,6 +2071,8 @@ def render_parent_prev_next(item):
     else :
         out += '<td class="dirs" width="40%" align="center"><font color="#AAAAAA">Next: </font></td>\n'
     out += '<td class="dirs" width="5%" align="center">'+GetLink(URL_BASE+'?video_search=1', 'Videos')+'</td>\n'
+    out += '<td class="dirs" width="5%" align="center">'+GetLink(URL_BASE+'?map=1', 'Map')+'</td>\n'
+    out += '<td class="dirs" width="5%" align="center">'+GetLink(URL_BASE+'?timeline=all', 'Timeline')+'</td>\n'
     out += '</tr></table>\n'
     return out
 
@@ -849,15 +2083,101 @@ def GetDirLinksHeading(dirItem):
     out += '</table>\n'
     return out
 
-def render_dirs_files_videos(dirs,files,videos,item):
+######## Sprites
+# With SPRITES = 1 the thumbnails on the page of a directory with at least SPRITE_MIN_FILES
+# images are packed into contact sheets of SPRITE_COLUMNS x SPRITE_ROWS thumbnails and shown as
+# CSS backgrounds, so the browser makes a handful of requests rather than one per thumbnail.
+# The sheets of a directory are made again whenever its mtime changes (an image added, renamed
+# or removed), the mtime is part of the sheet names so browsers never use stale ones.
+SPRITES = cfg.get_int("SPRITES", 0)
+SPRITE_MIN_FILES = cfg.get_int("SPRITE_MIN_FILES", 20)
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+SPRITE_DIR = cfg.get_str("SPRITE_DIR", "/sprites")
+
+@timed('sprites')
+def get_sprites(dirItem, files):
+    """ Returns {path: (sheet url, x, y, width, height)} for the thumbnails of files (the images
+    in dirItem), making the sheets first if they're missing or out of date. Files whose
+    thumbnail couldn't be made aren't included, None is returned if the sheets can't be made. """
+    fmt = get_rendition_format()
+    sprite_dir = PREVIEW_FILE_DIR+SPRITE_DIR
+    base = "dir"+urllib.parse.quote(dirItem._clean("/"+dirItem.path), '')
+    mapfile = "%s/%s.%s.json" % (sprite_dir, base, fmt)
+    try:
+        mtime = os.stat(dirItem.fullpath).st_mtime
+        with open(mapfile) as f:
+            sprites = json.load(f)
+    except (OSError, ValueError):
+        sprites = None
+
+    if sprites is None or sprites['mtime'] != mtime:
+        # made before the map is locked, making them takes the locks of the thumbnails
+        thumb_ok = [f.createThumbnail() for f in files]
+        def generate(tmpfile):
+            sheets = []
+            entries = {}
+            per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+            for start in range(0, len(files), per_sheet):
+                chunk = files[start:start+per_sheet]
+                width = min(len(chunk), SPRITE_COLUMNS) * THUMBNAIL_SIZE
+                height = (len(chunk) + SPRITE_COLUMNS - 1) // SPRITE_COLUMNS * THUMBNAIL_SIZE
+                sheet = Image.new("RGB", (width, height), (221, 221, 221))
+                for i, f in enumerate(chunk):
+                    if not thumb_ok[start+i]:
+                        continue
+                    x = i % SPRITE_COLUMNS * THUMBNAIL_SIZE
+                    y = i // SPRITE_COLUMNS * THUMBNAIL_SIZE
+                    with Image.open(f.thumbnail_local) as thumb:
+                        sheet.paste(thumb, (x, y))
+                        entries[f.path] = [len(sheets), x, y, thumb.size[0], thumb.size[1]]
+                name = "%s.%d.%d.%s" % (base, int(mtime), len(sheets), fmt)
+                sheet.save(sprite_dir+"/"+name+".tmp", **rendition_save_args('thumbnail'))
+                os.replace(sprite_dir+"/"+name+".tmp", sprite_dir+"/"+name)
+                sheets.append(name)
+            with open(tmpfile, 'w') as f:
+                json.dump({'mtime': mtime, 'sheets': sheets, 'files': entries}, f)
+        try:
+            os.makedirs(sprite_dir, exist_ok=True)
+            if not make_rendition(mapfile, 'sprite', generate, force=sprites is not None):
+                return None
+            with open(mapfile) as f:
+                sprites = json.load(f)
+            # the sheets of earlier versions of the directory (BASE.MTIME.SHEET.FMT)
+            old_sheet = re.compile(re.escape(base)+r"\.\d+\.\d+\."+re.escape(fmt))
+            for entry in os.scandir(sprite_dir):
+                if old_sheet.fullmatch(entry.name) and entry.name not in sprites['sheets']:
+                    os.remove(entry.path)
+        except Exception as exc:
+            logger.exception(exc)
+            return None
+
+    sheet_urls = [WEB_PREVIEW_FILE_DIR+SPRITE_DIR+"/"+name for name in sprites['sheets']]
+    return dict((path, (sheet_urls[sheet], x, y, w, h)) for path, (sheet, x, y, w, h) in sprites['files'].items())
+
+def render_dirs_files_videos(dirs,files,videos,item,sprites=None,summaries=None):
     ppn = render_parent_prev_next(item)
     out = ppn
 
     if len(dirs) > 0:
         out += GetDirLinksHeading(item)
 
-    for i in range(len(dirs)):
-        out += ('' if i == 0 else '<br/>')+GetLink(dirs[i].url, dirs[i].basename)+'\n'
+    if summaries is None:
+        for i in range(len(dirs)):
+            out += ('' if i == 0 else '<br/>')+GetLink(dirs[i].url, dirs[i].basename)+'\n'
+    elif len(dirs) > 0:
+        out += '<br/><center><table>\n'
+        columns = 5
+        col = 0
+        for d in dirs:
+            if col == 0:
+                out += '<tr>\n'
+            out += '<td valign="top"><center>'+get_dir_link_with_tile(d, summaries.get(d.path))+'</center></td>\n'
+            col += 1
+            if col == columns:
+                col = 0
+                out += '</tr>\n'
+        out += '</table></center>\n<br/>\n'
 
     if len(videos)> 0:
         out += '<br/><b>Video Links</b>\n'
@@ -883,7 +2203,8 @@ def render_dirs_files_videos(dirs,files,videos,item):
         for f in files:
             if col == 0:
                 out += '<tr>\n'
-            out += '<td><center>'+get_file_link_with_thumbnail(f, newTab=True)+'</center></td>\n'
+            sprite = None if sprites is None else sprites.get(f.path)
+            out += '<td><center>'+get_file_link_with_thumbnail(f, newTab=True, sprite=sprite)+'</center></td>\n'
             col += 1
             if col == columns:
                 col = 0
@@ -903,25 +2224,84 @@ def render_dirs_files_videos(dirs,files,videos,item):
     return out
 
 def render_dir_page(item):
-    dirs, files, videos = GetFilesAndDirs(item.path)
+    listed = time.time()
+    manifest = read_manifest(item)
+    dirs, files, videos = manifest if manifest is not None else GetFilesAndDirs(item.path)
+    if len(files) > 0:
+        record_access(item.path)
 
-    out = render_dirs_files_videos(dirs,files,videos,item=item)
+    sprites = get_sprites(item, files) if SPRITES and len(files) >= SPRITE_MIN_FILES else None
+    summaries = None
+    if DIR_TILES and len(dirs) > 0:
+        try:
+            summaries = get_dir_summaries(dirs)
+        except Exception as exc:
+            logger.exception(exc)
+    out = render_dirs_files_videos(dirs,files,videos,item=item,sprites=sprites,summaries=summaries)
+    if manifest is None or manifest_out_of_date(files):
+        write_manifest(item, dirs, files, videos, listed)
     return out
 
-def get_file_link_with_thumbnail(item, newTab=False):
-    exif_data = item.LoadExif()
-    thumb_ok = item.createThumbnail()
+def get_file_link_with_thumbnail(item, newTab=False, sprite=None):
+    if item._manifest_entry is None:
+        # otherwise the GPS position has come from the directory's manifest
+        exif_data = item.LoadExif()
+    if sprite is not None:
+        # the thumbnail is part of a contact sheet, see get_sprites()
+        sheet, x, y, w, h = sprite
+        map_link = '<img src="/webalbum/maps-pin.png">' if item.haveGps else ''
+        return '<br/>'+GetLink(item.url, '<div style="display:inline-block;width:%dpx;height:%dpx;border:3px solid black;'
+                               'background:url(%s) -%dpx -%dpx;"></div><br/>%s%s\n'
+                               % (w, h, sheet, x, y, map_link, item.basename_short), newTab=newTab)
+    if item.rendition_made(THUMBNAIL_SIZE):
+        # counted as make_rendition() would have, for the hit rate and --format-report
+        count_metric('webalbum_rendition_total', rendition=rendition_name(THUMBNAIL_SIZE),
+                     format=get_rendition_format(), result='hit')
+        thumb_ok = True
+    else:
+        thumb_ok = item.createThumbnail()
 
     out = ''
     imgPath = item.thumbnail_web if thumb_ok else ERROR_THUMBNAIL
+    # bigger thumbnails for high DPI screens
+    srcset = ' srcset="%s" sizes="%dpx"' % (item.srcset([s for s in RENDITION_SIZES if s <= THUMBNAIL_SIZE*2]),
+                                            THUMBNAIL_SIZE) if thumb_ok else ''
     thumb_error = '' if thumb_ok else 'ERROR: '
     map_link = '<img src="/webalbum/maps-pin.png">' if item.haveGps else ''
     out += '<br/>'+GetLink(item.url, '<img style="max-width:95%;border:3px solid black;" src="'+\
-            imgPath+'"><br/>'+map_link+thumb_error+item.basename_short+'</img>\n', newTab=newTab)
+            imgPath+'"'+srcset+'><br/>'+map_link+thumb_error+item.basename_short+'</img>\n', newTab=newTab)
     #out += "<p>%s</p>\n" % str(",".join(exif_data.keys()))
     #out += "<p>%s</p>\n" % str(gps)
     return out
 
+def _size_text(nbytes):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if nbytes < 1024 or unit == 'GB':
+            return ('%d %s' if unit == 'bytes' else '%.1f %s') % (nbytes, unit)
+        nbytes /= 1024.0
+
+def get_dir_link_with_tile(item, summary):
+    """ a directory as its cover thumbnail with what's in it and when it was taken underneath,
+    see get_dir_summaries() """
+    if summary is None:
+        return '<br/>'+GetLink(item.url, item.basename)+'\n'
+    cover = ''
+    if summary['cover'] is not None:
+        coverItem = AlbumItem(ALBUM_ROOT+'/'+summary['cover'])
+        cover = '<img style="max-width:95%%;border:3px solid black;" src="%s" loading="lazy"><br/>' \
+                % coverItem.sized_url(THUMBNAIL_SIZE)
+    counts = []
+    for key, name in (('images', 'photo'), ('videos', 'video'), ('subdirs', 'folder')):
+        if summary[key] > 0:
+            counts.append('%d %s%s' % (summary[key], name, '' if summary[key] == 1 else 's'))
+    if summary['images'] + summary['videos'] > 0:
+        counts.append(_size_text(summary['bytes']))
+    taken = ''
+    if summary['first_taken'] is not None:
+        first, last = summary['first_taken'][:10], summary['last_taken'][:10]
+        taken = '<br/>'+first+('' if first == last else ' to '+last)
+    return '<br/>'+GetLink(item.url, cover+'<b>'+item.basename+'</b>')+'<br/><small>'+', '.join(counts)+taken+'</small>\n'
+
 def get_file_link_with_view(item, newTab=False):
     view_ok = item.createView()
     exif_data = item.LoadExif()
@@ -929,33 +2309,39 @@ def get_file_link_with_view(item, newTab=False):
     view_error = '' if view_ok else 'ERROR: '
     out = ''
     imgPath = item.view_web if view_ok else ERROR_VIEW
+    # smaller views for phones and bigger ones for high DPI screens
+    srcset = ' srcset="%s" sizes="(max-width: %dpx) 95vw, %dpx"' % (
+        item.srcset([s for s in RENDITION_SIZES if s > THUMBNAIL_SIZE]), VIEW_SIZE * 100 // 95, VIEW_SIZE) \
+        if view_ok else ''
     out += '<br/>'+GetLink(item.full_view_url, '<img style="max-width:95%;border:3px solid black;" src="'+\
-            imgPath+'"><br/>'+('' if view_ok else 'ERROR: ')+item.basename+'</img>\n', newTab=newTab)
+            imgPath+'"'+srcset+'><br/>'+('' if view_ok else 'ERROR: ')+item.basename+'</img>\n', newTab=newTab)
     return out
 
+@timed('video')
 def get_video_link_with_thumbnail(item):
     outfile = item.thumbnail_local
+    def generate(tmpfile):
+        # make video thumbnail
+        clip = VideoFileClip(item.fullpath)
+        fps = clip.reader.fps
+        nframes = clip.reader.nframes
+        if clip.duration > 5.0:
+            frame_time = 5.0
+        elif clip.duration > 0.5:
+            frame_time = 0.5
+        else:
+            frame_time = 0.0
+        frame = clip.get_frame(frame_time)
+        pil_image = Image.fromarray(frame)
+
+        size = 250,250
+        pil_image.thumbnail(size)
+        pil_image.save(tmpfile, **rendition_save_args('thumbnail'))
     try:
-        if not os.path.exists(outfile):
-            # make video thumbnail
-            clip = VideoFileClip(item.fullpath)
-            fps = clip.reader.fps
-            nframes = clip.reader.nframes
-            if clip.duration > 5.0:
-                frame_time = 5.0
-            elif clip.duration > 0.5:
-                frame_time = 0.5
-            else:
-                frame_time = 0.0
-            frame = clip.get_frame(frame_time)
-            pil_image = Image.fromarray(frame)
-
-            size = 250,250
-            pil_image.thumbnail(size)
-            pil_image.save(outfile)
-        fileOk=True
+        fileOk = make_rendition(outfile, 'video', generate)
     except Exception as exc:
         logger.exception(exc)
+        count_metric('webalbum_rendition_total', rendition='video', format=get_rendition_format(), result='failure')
         fileOk=False
     out = ''
     imgPath = item.thumbnail_web if fileOk else ERROR_THUMBNAIL
@@ -973,11 +2359,12 @@ def get_item_index(item, items):
 
 def render_file_page(item):
     parent = AlbumItem(ALBUM_ROOT+'/'+item.parentdir)
+    record_access(parent.path)
     out = render_parent_prev_next(item)
     out += GetDirLinksHeading(parent)
     out += '<center>\n'
     parent.text = 'Back to directory gallery'
-    dirs, files, videos = GetFilesAndDirs(parent.path)
+    dirs, files, videos = list_dir(parent)
     fileIndex = get_item_index(item, files) # get the index of the file in the list of files in the directory
     out += '<table width="100%">\n<tr><td width="20%" align="top"><center>'
     if fileIndex > 0:
@@ -985,7 +2372,7 @@ def render_file_page(item):
     out += '</center></td>\n<td><center>'
     out += '<br/>'+GetLink(parent.url, parent.text)+'<br/>\n'
     out += get_file_link_with_view(item, newTab=True)
-    out += '<br/>Click image to see full size original\n'
+    out += '<br/>Click image to see it full screen (%s)\n' % GetLink(item.web_original, 'original', newTab=True)
     out += '</center></td>\n<td width="20%" align="top"><center>'
     if fileIndex < len(files) - 1:
         out += get_file_link_with_thumbnail(files[fileIndex+1])
@@ -995,11 +2382,35 @@ def render_file_page(item):
         out += addMap(item)
     out+='</center>\n'
 
+    upcoming = files[fileIndex+1:fileIndex+1+PREFETCH_COUNT]
+    # worked out before the background process starts making them, the url of one that isn't
+    # made yet makes it (or waits for the background process to) and redirects to it
+    view_urls = [i.sized_url(VIEW_SIZE) for i in upcoming]
+    prefetch_views(upcoming)
+    out += render_prefetch_links(view_urls + [i.url for i in upcoming[:1]])
+
     return out
 
+def render_sized(item, size):
+    """ makes one of the RENDITION_SIZES of an image (see AlbumItem.sized_url()) and redirects to it """
+    try:
+        size = int(size)
+    except ValueError:
+        size = None
+    if size not in RENDITION_SIZES or not filter_is_valid_file(item.fullpath):
+        return "Status: 404 Not Found\nContent-type: text/plain\n\nNot found\n"
+    if not item.createSized(size):
+        return "Status: 302 Found\nLocation: %s\n\n" % ERROR_VIEW
+    # the page asking for it had it down as not made, even if someone else has made it since
+    remove_manifest(AlbumItem(ALBUM_ROOT+'/'+item.parentdir))
+    return "Status: 302 Found\nLocation: %s\n\n" % item.sized_web(size)
+
 def render_full_image(item, nextImageLink=None):
-    img = '<img id="fullsize" src="%s" style="width: 100%%; height: 100%%;" class="rotate%d"/>' \
-          % (item.web_original, item.orientation_css)
+    # the browser picks the smallest size that fills the screen rather than fetching the original,
+    # they've all been rotated the right way up already
+    sizes = [s for s in RENDITION_SIZES if s >= VIEW_SIZE]
+    img = '<img id="fullsize" src="%s" srcset="%s" sizes="100vw" style="width: 100%%; height: 100%%;"/>' \
+          % (item.sized_url(VIEW_SIZE), item.srcset(sizes))
     if nextImageLink is None:
         return img+'\n'
     else :
@@ -1054,20 +2465,22 @@ function doResize(){
     return out
 
 def render_full_view_file_page(item):
-    """ This writes a very basic page with just the full size original as the body,
-    and the image links to the next full size original """
+    """ This writes a very basic page with just the image (the biggest rendition the screen
+    needs) as the body, and the image links to the next one """
     #return test_fs(item)
 
     parent = AlbumItem(ALBUM_ROOT+'/'+item.parentdir)
-    dirs, files, videos = GetFilesAndDirs(parent.path)
+    record_access(parent.path)
+    dirs, files, videos = list_dir(parent)
     fileIndex = get_item_index(item, files) # get the index of the file in the list of files in the directory
     out = HTML_Header_Thin()
     if fileIndex < len(files) - 1:
         nextImageLink = files[fileIndex+1].full_view_url
+        out += render_prefetch_links([nextImageLink])
     else:
         nextImageLink = None
     out += render_full_image(item, nextImageLink=nextImageLink)
-    return out+HTML_Footer_Thin(item.orientation)
+    return out+HTML_Footer_Thin()
 
 
 def unique_gps_items(items):
@@ -1085,6 +2498,7 @@ def unique_gps_items(items):
             ugi.append(item)
     return ugi
 
+@timed('map')
 def addMap(items):
     if type(items) is not list:
         items = [items]
@@ -1135,20 +2549,163 @@ def addMap(items):
     out += '</script>\n'
     return out
 
+def render_map_page(item):
+    """ The album-wide map, the markers are loaded from ?map_tile=z/x/y as the map is
+    moved around so only what is on screen ever gets fetched """
+    out = render_parent_prev_next(item)
+    out += '<br/><center><table><tr><td>\n'
+    out += '<div id="map-canvas"></div>\n'
+    out += '</td></tr></table></center>\n'
+    out += """<script type="text/javascript">
+var loaded_tiles = {};
+function get_map_options() {
+    return { center: { lat: 0, lng: 0}, zoom: 2 };
+}
+function lon2tile(lon, n) { return Math.floor((lon + 180) / 360 * n); }
+function lat2tile(lat, n) {
+    var r = lat * Math.PI / 180;
+    return Math.floor((1 - Math.log(Math.tan(r) + 1 / Math.cos(r)) / Math.PI) / 2 * n);
+}
+function addCluster(c) {
+    var latlng = new google.maps.LatLng(c[0], c[1]);
+    var marker = new google.maps.Marker({
+        position: latlng,
+        map: map,
+        label: c[2] > 1 ? String(c[2]) : null
+    });
+    google.maps.event.addListener(marker, "click", function () {
+        if (c[2] > 1 && map.getZoom() < MAX_ZOOM) {
+            map.setCenter(latlng);
+            map.setZoom(map.getZoom() + 2);
+        } else {
+            window.open("URL_BASE?path=" + c[3], "_blank");
+        }
+    });
+    return marker;
+}
+function loadTile(z, x, y) {
+    var key = z + "/" + x + "/" + y;
+    if (key in loaded_tiles) {
+        return;
+    }
+    loaded_tiles[key] = [];
+    var req = new XMLHttpRequest();
+    req.onload = function() {
+        var tile = JSON.parse(req.responseText);
+        for (var i = 0; i < tile.c.length; i++) {
+            loaded_tiles[key].push(addCluster(tile.c[i]));
+        }
+    };
+    req.open("GET", "URL_BASE?map_tile=" + key);
+    req.send();
+}
+function addMarkers() {
+    google.maps.event.addListener(map, "idle", function () {
+        var z = Math.min(map.getZoom(), MAX_ZOOM);
+        var n = Math.pow(2, z);
+        for (var key in loaded_tiles) {
+            if (key.split("/")[0] != String(z)) {
+                for (var i = 0; i < loaded_tiles[key].length; i++) {
+                    loaded_tiles[key][i].setMap(null);
+                }
+                delete loaded_tiles[key];
+            }
+        }
+        var b = map.getBounds();
+        var x0 = lon2tile(b.getSouthWest().lng(), n), x1 = lon2tile(b.getNorthEast().lng(), n);
+        var y0 = lat2tile(b.getNorthEast().lat(), n), y1 = lat2tile(b.getSouthWest().lat(), n);
+        if (x1 < x0) {
+            x1 += n;
+        }
+        for (var x = x0; x <= x1; x++) {
+            for (var y = Math.max(y0, 0); y <= Math.min(y1, n - 1); y++) {
+                loadTile(z, x % n, y);
+            }
+        }
+    });
+}
+</script>
+""".replace("URL_BASE", URL_BASE).replace("MAX_ZOOM", str(MAP_MAX_CLUSTER_ZOOM))
+    return out
+
+def render_map_tile(tile):
+    """ JSON for one map tile, tile is "z/x/y" """
+    try:
+        z, x, y = [int(v) for v in tile.split("/")]
+        clusters = [[lat, lon, count, escape_path(path)] for lat, lon, count, path in query_gps_tile(z, x, y)]
+    except Exception as exc:
+        logger.exception(exc)
+        clusters = []
+    out = "Content-type: application/json\n\n"
+    out += json.dumps({"c": clusters}, separators=(',', ':'))
+    return out
+
+# timeline values are "all", "YYYY", "YYYY-MM", "YYYY-MM-DD" or "START..END" for a range
+TIMELINE_MAX_ITEMS = 500
+
+# what ?timeline= accepts for START and END, a year, month or day
+TIMELINE_PERIOD = re.compile(r'^\d{4}(-\d{2}(-\d{2})?)?$')
+
+def render_timeline(period, rootItem):
+    """ Year -> month -> day histograms of when the photos were taken, then the photos
+    taken on that day (or in the START..END range). Everything comes from the index """
+    period = '' if period == 'all' else period.strip()
+    if ".." in period:
+        start, end = [p.strip() for p in period.split("..", 1)]
+    else:
+        start, end = period, None
+    if (start != '' or end is not None) and not all(TIMELINE_PERIOD.match(p) for p in (start, end) if p is not None):
+        return render_parent_prev_next(rootItem) + '<br/>Not a timeline period: %s\n' % html.escape(period)
+
+    crumbs = [GetLink(URL_BASE+'?timeline=all', 'Timeline')]
+    for length in (4, 7, 10):
+        if end is None and len(start) >= length:
+            crumbs.append(GetLink(URL_BASE+'?timeline='+start[:length], html.escape(start[:length])))
+    if end is not None:
+        crumbs.append(html.escape(start)+' to '+html.escape(end))
+    heading = '<table width="100%" border="0" cellpadding="3" cellspacking="3">\n'
+    heading += '<tr><td><b>'+' &gt; '.join(crumbs)+'</b></td></tr>\n'
+    heading += '</table>\n'
+
+    if end is None and len(start) < 10:
+        out = render_parent_prev_next(rootItem) + heading
+        histogram = query_taken_histogram(start)
+        if len(histogram) == 0:
+            return out + '<br/>No photos found\n'
+        biggest = max([count for p, count in histogram])
+        out += '<br/><table class="dirs">\n'
+        for p, count in histogram:
+            out += '<tr><td class="dirs">'+GetLink(URL_BASE+'?timeline='+p, p)+'</td>'
+            out += '<td class="dirs" align="right">%d</td>' % count
+            out += '<td class="dirs" width="600px"><div style="background:#0000aa;height:10px;width:%d%%"></div></td>' \
+                   % max(1, 100 * count // biggest)
+            out += '</tr>\n'
+        out += '</table>\n'
+        return out
+
+    found = query_taken_items(start, end, limit=TIMELINE_MAX_ITEMS + 1)
+    files = [AlbumItem(ALBUM_ROOT+'/'+path) for path, taken in found[:TIMELINE_MAX_ITEMS]]
+    out = heading
+    if len(found) > TIMELINE_MAX_ITEMS:
+        out += 'Only the first %d photos are shown<br/>\n' % TIMELINE_MAX_ITEMS
+    return out + render_dirs_files_videos([], files, [], item=rootItem)
+
 def render_error_page(path):
     return ''
 
+@timed('search', 'webalbum_search_seconds')
 def render_search(searchstr, rootItem):
     cmd = 'find %s -iname "*%s*"' % (ALBUM_ROOT, searchstr)
-    p = subprocess.Popen(shlex.split(cmd), stdout=PIPE)
+    p = subprocess.Popen(shlex.split(cmd), stdout=PIPE, universal_newlines=True)
     stdout,stderr = p.communicate()
     found_objects = sorted([o.strip() for o in stdout.split("\n") if len(o.strip()) > 0])
     dirs, files, videos = separate_files(found_objects)
     return render_dirs_files_videos(dirs, files, videos, item=rootItem)
 
+@timed('search', 'webalbum_search_seconds')
 def render_video_search(rootItem):
     cmd = 'find %s -regextype sed -iregex ".*/.*\(mp4\|avi\)"' % ALBUM_ROOT
-    p = subprocess.Popen(shlex.split(cmd), stdout=PIPE)
+    p = subprocess.Popen(shlex.split(cmd), stdout=PIPE, universal_newlines=True)
     stdout,stderr = p.communicate()
     found_objects = sorted([o.strip() for o in stdout.split('\n') if len(o.strip()) > 0])
     dirs, files, videos = separate_files(found_objects)
@@ -1168,47 +2725,557 @@ def render_clear_cache(searchstr, item):
     p = subprocess.Popen(shlex.split(cmdviews), stdout=PIPE)
     stdout, stderr = p.communicate()
     #out +=  str(stdout)+"<br/>"+str(stderr)+"<br/>"
+    remove_manifests()
     out += '<br/>Files cleared<br/>\n\n' + render_dir_page(item)
     return out
 
 def render_page():
+    page_type = 'error'
     try:
+        reset_timings()
         reqMethod = GetRequestMethod()
         #if reqMethod=="POST":
         #    pass
         path = get_path()
 
+        if metrics_view:
+            page_type = 'metrics'
+            sys.stdout.write(render_metrics())
+            return
+
+        if len(map_tile) > 0:
+            page_type = 'map_tile'
+            out = render_map_tile(map_tile)
+            sys.stdout.write(server_timing_header(get_timings()))
+            sys.stdout.write(out)
+            return
+
         item = AlbumItem(ALBUM_ROOT+'/'+path)
+        if len(size_request) > 0:
+            page_type = 'size'
+            sys.stdout.write(render_sized(item, size_request))
+            return
+
         full_view = isFullView()
         if full_view:
+            page_type = 'full_view'
             page = render_full_view_file_page(item)
         elif len(searchstr) > 0:
             if clearcache:
+                page_type = 'clear_cache'
                 page = render_clear_cache(searchstr, item)
             else:
+                page_type = 'search'
                 page = render_search(searchstr,item)
         elif video_search == '1':
+            page_type = 'video_search'
             page = render_video_search(item)
+        elif map_view == '1':
+            page_type = 'map'
+            page = render_map_page(item)
+        elif len(timeline) > 0:
+            page_type = 'timeline'
+            page = render_timeline(timeline, item)
         elif item.isdir:
+            page_type = 'dir'
             page = render_dir_page(item)
         elif item.isfile:
+            page_type = 'file'
             page = render_file_page(item)
         else:
             page = render_error_page(item)
 
+        timings = get_timings()
+        log_timings(timings, path)
+        sys.stdout.write(server_timing_header(timings))
+        # the thumbnails and views linked to depend on the image formats the browser accepts
+        sys.stdout.write('Vary: Accept\n')
+
         if not full_view:
             sys.stdout.write(HTML_Header('Photo Gallery'))
 
         sys.stdout.write(page)
 
         if not full_view:
+            if DEBUG_TIMING:
+                sys.stdout.write(render_timing_footer(timings))
             sys.stdout.write(HTML_Footer())
     except Exception as exc:
         logger.exception(exc)
+        page_type = 'error'
         sys.stdout.write('Content type: text/html\n\n')
         sys.stdout.write(traceback.format_exc())
+    finally:
+        # the page has been written, get it out before updating the metrics
+        sys.stdout.flush()
+        count_metric('webalbum_requests_total', page=page_type)
+        observe_metric('webalbum_request_seconds', time.time() - request_start, page=page_type)
+        flush_metrics()
+        if page_type in ('dir', 'file', 'full_view'):
+            maybe_evict_cache()
+
+######## Rendition format report
+def format_report():
+    """ Prints the space taken by the thumbnails and views in each format and, for images that
+    have a JPEG and a WebP/AVIF copy, how much smaller the WebP/AVIF ones are. The bytes saved
+    in transfers are estimated from the number of times each format was served (from the
+    metrics) times the average saving per image """
+    served = {}
+    try:
+        for labels, value in get_index_db().execute(
+                "SELECT labels, value FROM metrics WHERE name = 'webalbum_rendition_total'"):
+            l = dict(kv.split('=', 1) for kv in labels.replace('"', '').split(','))
+            if l.get('result') in ('hit', 'miss', 'coalesced'):
+                key = (l.get('rendition'), l.get('format', 'jpg'))
+                served[key] = served.get(key, 0) + value
+    except sqlite3.Error as exc:
+        logger.warning("no metrics: %s", exc)
+    print("%-10s %-5s %8s %14s %10s %8s %10s %16s" % ('rendition', 'fmt', 'files', 'bytes', 'avg', 'vs jpg',
+                                                     'served', 'est. bytes saved'))
+    for rendition, subdir in (('thumbnail', THUMBNAIL_DIR), ('view', VIEW_DIR)):
+        sizes = {}
+        for entry in os.scandir(PREVIEW_FILE_DIR+subdir):
+            base, ext = os.path.splitext(entry.name)
+            if ext in ('.jpg', '.webp', '.avif'):
+                sizes.setdefault(base, {})[ext[1:]] = entry.stat().st_size
+        for fmt in ('jpg', 'webp', 'avif'):
+            files = [f[fmt] for f in sizes.values() if fmt in f]
+            if len(files) == 0:
+                continue
+            pairs = [(f['jpg'], f[fmt]) for f in sizes.values() if fmt in f and 'jpg' in f]
+            count = served.get((rendition, fmt), 0)
+            if fmt != 'jpg' and len(pairs) > 0:
+                jpg_bytes = sum(j for j, m in pairs)
+                saving = 1.0 - sum(m for j, m in pairs) / float(jpg_bytes)
+                vs_jpg = '%.0f%%' % (-100.0 * saving)
+                saved = '%d' % (count * saving * jpg_bytes / len(pairs))
+            else:
+                vs_jpg = saved = '-'
+            print("%-10s %-5s %8d %14d %10d %8s %10d %16s" % (rendition, fmt, len(files), sum(files),
+                                                              sum(files) / len(files), vs_jpg, count, saved))
+
+######## Warming the cache
+# After the data dir has been restored or moved every thumbnail would otherwise be made by
+# whoever browses to it first. "webalbum-warm" (webalbum --warm) walks the album and makes the
+# thumbnails, views and EXIF/GPS files that are missing or older than their image, a directory
+# at a time in --workers processes. The workers run at a lower priority (--nice) and keep the
+# bytes they read under --rate MB/s between them so the site stays usable while they run.
+# Each directory finished is added to a checkpoint file, a run that's stopped picks up from
+# there next time and the checkpoint is removed once the whole album has been done.
+
+WARM_COUNTS = ('files', 'present', 'made', 'stale', 'failed', 'exif', 'exif_failed', 'dirs_failed', 'bytes')
+
+def _warm_init(nice):
+    # warm_cache() closed its database connection before the workers were forked, they each
+    # open their own
+    if nice > 0:
+        os.nice(nice)
+
+def _is_stale(filepath, mtime):
+    """ None if filepath is missing, otherwise whether it is older than mtime """
+    try:
+        return os.stat(filepath).st_mtime < mtime
+    except OSError:
+        return None
+
+def warm_dir(path, sizes, formats, rate):
+    """ Makes what's missing or stale for the images directly in path (relative to ALBUM_ROOT),
+    reading at most rate bytes a second. Returns (path, counts of WARM_COUNTS). """
+    counts = dict.fromkeys(WARM_COUNTS, 0)
+    read = _bytes_read()
+    try:
+        _warm_files(path, sizes, formats, rate, counts)
+    except Exception:
+        # the rest of the album is still warmed, this directory is tried again next run
+        logger.exception("couldn't warm %s", path or '/')
+        counts['failed'] += 1
+        counts['dirs_failed'] += 1
+    counts['bytes'] = _bytes_read() - read
+    return path, counts
+
+def _warm_files(path, sizes, formats, rate, counts):
+    global http_accept
+    start = time.time()
+    read = _bytes_read()
+    dirs, files, videos = GetFilesAndDirs(path)
+    for f in files:
+        counts['files'] += 1
+        try:
+            mtime = os.stat(f.fullpath).st_mtime
+        except OSError:
+            continue
+        stale = _is_stale(f.meta_file_local, mtime)
+        if stale is not False:
+            counts['exif' if f.createExifFile(force=stale is True) else 'exif_failed'] += 1
+        for fmt in formats:
+            http_accept = 'image/'+fmt
+            # biggest first so the smaller sizes are made from it rather than the original
+            for size in sorted(sizes, reverse=True):
+                stale = _is_stale(f.sized_local(size), mtime)
+                if stale is False:
+                    counts['present'] += 1
+                elif f.createSized(size, force=stale is True):
+                    counts['stale' if stale else 'made'] += 1
+                else:
+                    counts['failed'] += 1
+        if rate > 0:
+            # sleep until the bytes read so far are within the rate
+            ahead = (_bytes_read() - read) / float(rate) - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def _read_checkpoint(checkpoint):
+    done = {}
+    if os.path.isfile(checkpoint):
+        with open(checkpoint) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    done[entry['path']] = entry['mtime']
+                except (ValueError, KeyError):
+                    # the last line of a checkpoint that was being written when the run stopped
+                    continue
+    return done
+
+def warm_cache(workers, sizes=None, formats=None, rate=0, nice=10, checkpoint=None):
+    """ Warms the cache of the whole album (see above), rate is in MB/s for all the workers
+    together (0 for no limit). Prints a report at the end and returns the totals. """
+    import concurrent.futures
+    import multiprocessing
+    sizes = sizes or [THUMBNAIL_SIZE, VIEW_SIZE]
+    if formats is None:
+        Image.init()
+        formats = [f for f in RENDITION_FORMATS if f.upper() in Image.SAVE][:1] or ['jpg']
+    checkpoint = checkpoint or PREVIEW_FILE_DIR+"/warm.checkpoint"
+    os.makedirs(PREVIEW_FILE_DIR+THUMBNAIL_DIR, exist_ok=True)
+
+    done = _read_checkpoint(checkpoint)
+    todo = []
+    skipped = 0
+    for dirpath, dirnames, filenames in os.walk(ALBUM_ROOT):
+        dirnames.sort()
+        path = AlbumItem(dirpath).path
+        if done.get(path) == os.stat(dirpath).st_mtime:
+            skipped += 1
+        elif any(filter_is_valid_file(os.path.join(dirpath, f)) for f in filenames):
+            todo.append(path)
+    logger.info("warming %d directories (%d done already) with %d workers", len(todo), skipped, workers)
+
+    totals = dict.fromkeys(WARM_COUNTS, 0)
+    start = time.time()
+    close_index_db()
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_warm_init, initargs=(nice,),
+                                                      mp_context=multiprocessing.get_context('fork'))
+    try:
+        with open(checkpoint, 'a') as cp:
+            futures = [executor.submit(warm_dir, path, sizes, formats, rate * 1048576.0 / workers) for path in todo]
+            for future in concurrent.futures.as_completed(futures):
+                path, counts = future.result()
+                for key in WARM_COUNTS:
+                    totals[key] += counts[key]
+                if counts['dirs_failed']:
+                    continue
+                cp.write(json.dumps({'path': path, 'mtime': os.stat(ALBUM_ROOT+"/"+path).st_mtime}) + '\n')
+                cp.flush()
+                logger.info("warmed %s %s", path or '/', json.dumps(counts, sort_keys=True))
+    finally:
+        executor.shutdown(cancel_futures=True)
+    if totals['dirs_failed'] == 0:
+        os.remove(checkpoint)
+
+    elapsed = time.time() - start
+    wanted = totals['files'] * len(sizes) * len(formats)
+    there = totals['present'] + totals['made'] + totals['stale']
+    print("directories   %d warmed, %d done by an earlier run, %d failed"
+          % (len(todo) - totals['dirs_failed'], skipped, totals['dirs_failed']))
+    print("images        %d (%d metadata files made, %d failed)" % (totals['files'], totals['exif'], totals['exif_failed']))
+    print("renditions    %d made, %d stale ones made again, %d already there, %d failed"
+          % (totals['made'], totals['stale'], totals['present'], totals['failed']))
+    print("sizes         %s in %s" % (', '.join(str(s) for s in sizes), ', '.join(formats)))
+    print("coverage      %.1f%%" % (100.0 * there / wanted if wanted else 100.0))
+    print("time          %.1fs, %.1f images/s, %.1f MB/s read" % (elapsed, totals['files'] / max(elapsed, 0.001),
+                                                                   totals['bytes'] / 1048576.0 / max(elapsed, 0.001)))
+    return totals
+
+######## Built in server
+# For small setups without nginx/uwsgi (and for testing) "webalbum --serve PORT" serves the
+# whole album itself: pages at URL_BASE, the thumbnails and views under WEB_PREVIEW_FILE_DIR
+# and the originals under WEB_ORIGINALS_ROOT. Files go out with sendfile() (with range
+# requests so videos can be seeked) straight from the event loop, pages are rendered by a
+# fixed number of worker processes so a page busy generating thumbnails never holds up
+# anything else.
+
+# seconds an idle keep-alive connection is kept open
+SERVER_KEEPALIVE = 15
+
+HTTP_REASONS = {200: 'OK', 206: 'Partial Content', 301: 'Moved Permanently', 304: 'Not Modified',
+                400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                416: 'Range Not Satisfiable', 500: 'Internal Server Error'}
+
+def render_request(query, accept=''):
+    """ renders one page in a server worker process, returns the CGI output """
+    read_request({'REQUEST_METHOD': 'GET', 'QUERY_STRING': query, 'HTTP_ACCEPT': accept})
+    out = io.StringIO()
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        render_page()
+    finally:
+        sys.stdout = stdout
+    return out.getvalue()
+
+def static_file_path(url_path):
+    """ returns the local file for a preview or original url or None """
+    for web_root, local_root in ((WEB_PREVIEW_FILE_DIR, PREVIEW_FILE_DIR), (WEB_ORIGINALS_ROOT, ALBUM_ROOT)):
+        if url_path.startswith(web_root+'/'):
+            relpath = urllib.parse.unquote(url_path[len(web_root)+1:])
+            parts = relpath.split('/')
+            if '..' in parts or '' in parts or '\0' in relpath:
+                return None
+            return local_root+'/'+relpath
+    return None
+
+def parse_range(header, size):
+    """ returns (start, end) (end inclusive) of a "bytes=" range header, None if it can't be
+    satisfied and (0, size - 1) when there is no (usable) range """
+    if not header.startswith('bytes=') or ',' in header:
+        return 0, size - 1
+    start, _, end = header[6:].strip().partition('-')
+    try:
+        if start == '':
+            length = int(end)
+            if length == 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end != '' else size - 1
+    except ValueError:
+        return 0, size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+def _http_date(t):
+    return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(t))
+
+async def _send_response(writer, status, headers, body=b'', head_only=False):
+    lines = ['HTTP/1.1 %d %s' % (status, HTTP_REASONS.get(status, ''))]
+    if 'Content-Length' not in headers:
+        headers['Content-Length'] = str(len(body))
+    lines += ['%s: %s' % (k, v) for k, v in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    if not head_only and body:
+        writer.write(body)
+    await writer.drain()
+
+async def _send_file(loop, writer, filepath, request_headers, head_only):
+    try:
+        f = open(filepath, 'rb')
+    except OSError:
+        await _send_response(writer, 404, {'Content-Type': 'text/plain'}, b'Not found\n', head_only)
+        return 404
+    with f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            await _send_response(writer, 404, {'Content-Type': 'text/plain'}, b'Not found\n', head_only)
+            return 404
+        headers = {
+            'Content-Type': mimetypes.guess_type(filepath)[0] or 'application/octet-stream',
+            'Last-Modified': _http_date(st.st_mtime),
+            'Accept-Ranges': 'bytes',
+        }
+        if request_headers.get('if-modified-since') == headers['Last-Modified']:
+            await _send_response(writer, 304, headers, head_only=True)
+            return 304
+        status = 200
+        start, end = 0, st.st_size - 1
+        if 'range' in request_headers and st.st_size > 0:
+            byte_range = parse_range(request_headers['range'], st.st_size)
+            if byte_range is None:
+                headers['Content-Range'] = 'bytes */%d' % st.st_size
+                await _send_response(writer, 416, headers, head_only=head_only)
+                return 416
+            start, end = byte_range
+            if (start, end) != (0, st.st_size - 1):
+                status = 206
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, st.st_size)
+        headers['Content-Length'] = str(end - start + 1)
+        await _send_response(writer, status, headers, head_only=True)
+        if not head_only and end >= start:
+            await loop.sendfile(writer.transport, f, start, end - start + 1)
+        return status
+
+async def _send_page(loop, executor, writer, query, accept, head_only):
+    try:
+        out = await loop.run_in_executor(executor, render_request, query, accept)
+    except Exception as exc:
+        logger.exception(exc)
+        await _send_response(writer, 500, {'Content-Type': 'text/plain'}, b'Internal server error\n', head_only)
+        return 500
+    head, _, body = out.partition('\n\n')
+    status = 200
+    headers = {}
+    for line in head.split('\n'):
+        name, _, value = line.partition(':')
+        name = name.strip()
+        if name.lower() == 'status':
+            status = int(value.split()[0])
+        elif name.lower() in ('content-type', 'content type'):
+            headers['Content-Type'] = value.strip()
+        elif name:
+            headers[name] = value.strip()
+    await _send_response(writer, status, headers, body.encode('utf-8', 'surrogateescape'), head_only)
+    return status
+
+async def handle_connection(reader, writer, executor):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), SERVER_KEEPALIVE)
+            except asyncio.TimeoutError:
+                break
+            if not request_line:
+                break
+            request_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                request_headers[name.strip().lower()] = value.strip()
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                await _send_response(writer, 400, {'Connection': 'close'})
+                break
+            start = time.time()
+            keep_alive = request_headers.get('connection', '').lower() != 'close' and \
+                         (version == 'HTTP/1.1' or request_headers.get('connection', '').lower() == 'keep-alive')
+            url_path, _, query = target.partition('?')
+            head_only = method == 'HEAD'
+            if method not in ('GET', 'HEAD'):
+                status = 405
+                await _send_response(writer, status, {'Allow': 'GET, HEAD'}, head_only=head_only)
+            elif url_path == URL_BASE:
+                status = await _send_page(loop, executor, writer, query, request_headers.get('accept', ''), head_only)
+            elif url_path == '/':
+                status = 301
+                await _send_response(writer, status, {'Location': URL_BASE}, head_only=head_only)
+            else:
+                filepath = static_file_path(url_path)
+                if filepath is None:
+                    status = 404
+                    await _send_response(writer, status, {'Content-Type': 'text/plain'}, b'Not found\n', head_only)
+                else:
+                    status = await _send_file(loop, writer, filepath, request_headers, head_only)
+            logger.info('%s "%s %s" %d %.1fms', writer.get_extra_info('peername', ('-',))[0],
+                        method, target, status, (time.time() - start) * 1000.0)
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+def serve(address, workers):
+    """ runs the built in server on address ("PORT" or "HOST:PORT") until interrupted """
+    import asyncio
+    import concurrent.futures
+    import multiprocessing
+    host, _, port = address.rpartition(':')
+    mimetypes.add_type('image/webp', '.webp')
+    mimetypes.add_type('image/avif', '.avif')
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                      mp_context=multiprocessing.get_context('fork'))
+
+    async def run():
+        server = await asyncio.start_server(lambda r, w: handle_connection(r, w, executor),
+                                            host or None, int(port))
+        logger.info("serving %s on %s with %d page workers", ALBUM_ROOT,
+                    ', '.join(str(s.getsockname()) for s in server.sockets), workers)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def main():
+    """ Command line maintenance tasks, run inside the container eg:
+    docker exec -it CONTAINER /var/www/cgi-bin/cgi/webalbum --build-index
+    or the built in server: webalbum --serve 8000 """
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('--build-index', dest='build_index', default=False, action='store_true',
+                      help='walk the whole album and (re)build the index database')
+    parser.add_option('--format-report', dest='format_report', default=False, action='store_true',
+                      help='show the space (and transfers) saved by the WebP/AVIF thumbnails and views')
+    parser.add_option('--serve', dest='serve', default=None, metavar='[HOST:]PORT',
+                      help='run the built in web server rather than running under a web server')
+    parser.add_option('--workers', dest='workers', type='int', default=os.cpu_count() or 2,
+                      help='processes rendering pages for --serve or warming for --warm (default: number of CPUs)')
+    parser.add_option('--evict', dest='evict', default=False, action='store_true',
+                      help='remove the least recently used renditions of the classes over their budget now')
+    parser.add_option('--warm', dest='warm', default=False, action='store_true',
+                      help='make the thumbnails, views and metadata files that are missing or stale')
+    parser.add_option('--sizes', dest='sizes', default=None,
+                      help='sizes made by --warm, eg 250,900,1600 (default: the thumbnail and view sizes)')
+    parser.add_option('--formats', dest='formats', default=None,
+                      help='formats made by --warm, eg avif,jpg (default: the first of RENDITION_FORMATS PIL can write)')
+    parser.add_option('--rate', dest='rate', type='float', default=0,
+                      help='MB/s --warm may read between all its workers (default: no limit)')
+    parser.add_option('--nice', dest='nice', type='int', default=10,
+                      help='niceness --warm runs its workers at (default: 10)')
+    parser.add_option('--checkpoint', dest='checkpoint', default=None,
+                      help='file --warm records finished directories in (default: warm.checkpoint in the data dir)')
+    parser.add_option('--convert-sidecars', dest='convert_sidecars', default=False, action='store_true',
+                      help='turn the pickled .exif/.gps files of older versions into .meta files')
+    (options, args) = parser.parse_args()
+
+    if options.convert_sidecars:
+        converted, dropped = convert_sidecars()
+        print("%d converted, %d dropped (made again from their image when needed)" % (converted, dropped))
+        return 0
+
+    if options.build_index:
+        build_album_index()
+        return 0
+
+    if options.format_report:
+        format_report()
+        return 0
+
+    if options.serve:
+        serve(options.serve, options.workers)
+        return 0
+
+    if options.evict:
+        for cache_class, (files, nbytes) in sorted(evict_cache().items()):
+            print("%-10s %8d files %14d bytes removed" % (cache_class, files, nbytes))
+        return 0
+
+    if options.warm:
+        sizes = [int(v) for v in options.sizes.split(',')] if options.sizes else None
+        if sizes is not None and any(size not in RENDITION_SIZES for size in sizes):
+            parser.error('--sizes have to be in RENDITION_SIZES (%s)' % ','.join(str(s) for s in RENDITION_SIZES))
+        formats = [f.strip().lower() for f in options.formats.split(',')] if options.formats else None
+        if formats is not None and any(f != 'jpg' and f not in RENDITION_FORMATS for f in formats):
+            parser.error('--formats have to be jpg or in RENDITION_FORMATS (%s)' % ','.join(RENDITION_FORMATS))
+        warm_cache(options.workers, sizes=sizes, formats=formats, rate=options.rate, nice=options.nice,
+                   checkpoint=options.checkpoint)
+        return 0
+
+    parser.print_help()
+    return 1
 
 if __name__ == '__main__':
+    if 'REQUEST_METHOD' not in os.environ:
+        sys.exit(main())
     cgitb.enable() # enable error info in the webpage
     render_page()
 